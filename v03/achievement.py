@@ -12,17 +12,64 @@ Created on Sun Aug 30 09:08:18 2020
 import random
 
 from enum import Enum
+from functools import lru_cache
 from resource import Resource, ResourceDie, LocationResourceDie
 from location import Location
 
-# Used to find all the subsets that add or exceed a particular number
-def subset_sum(loc_dice, target, partial = [], partial_sum = 0):
-    
-    if partial_sum >= target:
-        yield partial, partial_sum
-    for i, loc_die in enumerate(loc_dice):
-        remaining = loc_dice[i + 1:]
-        yield from subset_sum(remaining, target, partial + [loc_die], partial_sum + loc_die.die.value)
+# Finds the dice faces that reach the target with the smallest total, as
+# the cheapest way to pay for an achievement. Faces only run from 1-6, so
+# rather than trying every subset of dice this is a dynamic program over how
+# many of each face are used, keeping the best faces for every reachable
+# total. Ties between totals go to the faces which sort first, e.g. (1, 6)
+# is chosen over (3, 4) for a target of 7, so the lowest dice are spent.
+# Returns the chosen faces in ascending order, or None if the dice can't
+# reach the target.
+def min_overshoot_cover(faces, target):
+
+    counts = [0] * 7
+    for face in faces:
+        counts[face] += 1
+
+    # Dropping any die from a cover more than 5 over the target still
+    # leaves a cover, so larger totals never need to be tracked
+    limit = target + 5
+
+    best = {0: ()}
+    for face in range(1, 7):
+        extended = dict(best)
+        for partial_sum, partial in best.items():
+            for k in range(1, counts[face] + 1):
+                total = partial_sum + k * face
+                if total > limit:
+                    break
+                candidate = partial + (face,) * k
+                current = extended.get(total)
+                if current is None or candidate < current:
+                    extended[total] = candidate
+        best = extended
+
+    for total in range(max(target, 0), limit + 1):
+        if total in best:
+            return best[total]
+
+    return None
+
+# Boards repeat heavily between games, and there are only a few hundred
+# sorted sets of location dice, so covers are cached on the sorted faces
+# and target rather than solved again on every step
+COVER_CACHE_SIZE = 4096
+
+@lru_cache(maxsize = COVER_CACHE_SIZE)
+def _cached_cover(sorted_faces, target):
+    return min_overshoot_cover(sorted_faces, target)
+
+# Hit and miss counts for the cover cache, useful for checking the hit
+# rate over long training runs
+def cover_cache_info():
+    return _cached_cover.cache_info()
+
+def clear_cover_cache():
+    _cached_cover.cache_clear()
     
 class AchievementType(Enum):
     SUM = 1
@@ -54,8 +101,9 @@ class SumResourceAchievement(Achievement):
     def __repr__(self):
         return self.__str__()
         
-    # A simple hueristic to complete a sum achievemnt - will take the lowest
-    # valued dice that equal or exceed the achievement total
+    # Pays for the achievement with the lowest valued dice that equal or
+    # exceed the achievement total. Returns the dice used along with their
+    # sum, or False if the locations don't hold enough.
     def completed(self, locations):
         
         ld = []
@@ -65,17 +113,23 @@ class SumResourceAchievement(Achievement):
                 for die in loc.rpool:
                     ld.append(LocationResourceDie(die, loc))
         
-        subsets = []
-        for subset in subset_sum(ld, self.total):
-            subsets.append(subset)
-            
-        subsets.sort(key = lambda tup: tup[1])
+        faces = tuple(sorted(d.die.value for d in ld))
+        cover = _cached_cover(faces, self.total)
         
-        if(subsets):
-            return subsets[0]
-        else:
+        if cover is None:
             return False
         
+        # Each face is taken from the first location holding it
+        subset = []
+        remaining = list(ld)
+        for face in cover:
+            for i, loc_die in enumerate(remaining):
+                if loc_die.die.value == face:
+                    subset.append(remaining.pop(i))
+                    break
+        
+        return subset, sum(cover)
+        
     def encode(self):
         obs = super().encode()
         obs.append(self.resource_type.value)
@@ -103,4 +157,5 @@ if __name__ == "__main__":
     
     print(ach1.completed(locs))
     
-    print(ach1.encode())
\ No newline at end of file
+    print(ach1.encode())
+    print(cover_cache_info())
\ No newline at end of file
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Trains a DQN with actors and a learner in separate processes. Each actor
+plays a batch of Six Winters games with its own epsilon, and writes its
+transitions to a ring buffer in shared memory. The learner, in the main
+process, drains the rings into its replay memory and trains continuously,
+publishing its weights to shared memory every so often for the actors to
+pick up.
+
+Actors evaluate the network with NumPy, so they don't load TensorFlow at
+all, and nothing is pickled once they are running: transitions and weights
+only move through shared memory. The shared memory is a multiprocessing
+RawArray, created by the learner and handed to the actors when they start.
+"""
+
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+from replay import ReplayMemory, PrioritizedReplayMemory, transition_dtype
+from vec_env import VecSixWinters, OBS_SIZE, NUM_ACTIONS
+
+# Each actor's ring starts with a header of int64 counters: transitions
+# written, games finished, the total score of those games and the most
+# transitions written at once
+HEADER_SIZE = 64
+WRITTEN, GAMES, SCORE, BATCH = range(4)
+
+# The hidden layers of qlearning.build_model
+HIDDEN_LAYERS = (64, 32, 16)
+
+def layer_shapes(obs_size = OBS_SIZE, num_actions = NUM_ACTIONS):
+    sizes = (obs_size,) + HIDDEN_LAYERS + (num_actions,)
+    shapes = []
+    for inputs, outputs in zip(sizes[:-1], sizes[1:]):
+        shapes += [(inputs, outputs), (outputs,)]
+    return shapes
+
+# The epsilon of each actor, spread from 0.4 down to 0.4 ** 8, so some
+# actors explore widely while others play close to greedily
+def actor_epsilons(num_actors, base = 0.4, spread = 7.0):
+    if num_actors == 1:
+        return [base]
+    return [base ** (1 + spread * i / (num_actors - 1)) for i in range(num_actors)]
+
+# A single writer ring of transitions in shared memory. Rows are written
+# before the count of transitions written is updated, so a reader only
+# sees rows once they're complete. The writer never waits for the reader,
+# so a slow reader loses transitions rather than slowing the writer down.
+# The ring is created with a new buffer, zeroed, or opened on the buffer of
+# an existing ring.
+class TransitionRing:
+
+    def __init__(self, capacity, obs_size = OBS_SIZE, buffer = None,
+                 context = multiprocessing):
+        self.capacity = capacity
+        dtype = transition_dtype(obs_size)
+        if buffer is None:
+            buffer = context.RawArray('B', HEADER_SIZE + capacity * dtype.itemsize)
+        self.buffer = buffer
+        self.header = np.frombuffer(buffer, np.int64, HEADER_SIZE // 8)
+        self.transitions = np.frombuffer(buffer, dtype, capacity, HEADER_SIZE)
+        self.read = 0
+        self.dropped = 0
+
+    def write(self, states, actions, rewards, next_states, dones):
+        written = int(self.header[WRITTEN])
+        if len(states) > self.header[BATCH]:
+            self.header[BATCH] = len(states)
+        rows = (written + np.arange(len(states))) % self.capacity
+        transitions = self.transitions
+        transitions['state'][rows] = states
+        transitions['action'][rows] = actions
+        transitions['reward'][rows] = rewards
+        transitions['next_state'][rows] = next_states
+        transitions['done'][rows] = dones
+        self.header[WRITTEN] = written + len(states)
+
+    # Copies the transitions written since the last read. While they are
+    # copied the writer carries on, and may overwrite the oldest. Once the
+    # copy is done, any row the writer could have reached by then, up to a
+    # batch past the count it has written, is dropped, so every transition
+    # returned is whole. Those dropped, and any the writer lapped before
+    # the read, are counted in dropped.
+    def read_new(self):
+        written = int(self.header[WRITTEN])
+        start = max(self.read, written - self.capacity + int(self.header[BATCH]))
+        indices = np.arange(start, written)
+        copied = self.transitions[indices % self.capacity]
+        whole = indices >= (int(self.header[WRITTEN]) - self.capacity +
+                            int(self.header[BATCH]))
+        self.dropped += start - self.read + int((~whole).sum())
+        self.read = written
+        return copied[whole]
+
+    def close(self):
+        del self.header, self.transitions
+
+# Network weights in shared memory, published by one writer behind a
+# version counter. The version is odd while the weights are being written,
+# so a reader which sees the same even version before and after copying
+# them knows the copy is whole.
+class WeightBoard:
+
+    def __init__(self, shapes, buffer = None, context = multiprocessing):
+        self.shapes = shapes
+        self.sizes = [int(np.prod(shape)) for shape in shapes]
+        if buffer is None:
+            buffer = context.RawArray('B', 8 + 4 * sum(self.sizes))
+        self.buffer = buffer
+        self.version = np.frombuffer(buffer, np.int64, 1)
+        self.flat = np.frombuffer(buffer, np.float32, sum(self.sizes), 8)
+
+    def publish(self, weights):
+        self.version[0] += 1
+        self.flat[:] = np.concatenate([w.ravel() for w in weights])
+        self.version[0] += 1
+
+    # The weights and their version if newer than the given one, else None
+    def read_newer(self, version):
+        before = int(self.version[0])
+        if before <= version or before % 2:
+            return None
+        flat = self.flat.copy()
+        if int(self.version[0]) != before:
+            return None
+        weights = []
+        offset = 0
+        for shape, size in zip(self.shapes, self.sizes):
+            weights.append(flat[offset:offset + size].reshape(shape))
+            offset += size
+        return weights, before
+
+    def close(self):
+        del self.version, self.flat
+
+# The Q values of a batch of observations, with the dense elu network of
+# qlearning.build_model
+def q_values(weights, obs):
+    x = obs.astype(np.float32)
+    last = len(weights) - 2
+    for i in range(0, len(weights), 2):
+        x = x @ weights[i] + weights[i + 1]
+        if i < last:
+            x = np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+    return x
+
+# Plays games until stop is set. The actor acts at random until the first
+# weights are published, then checks for new ones every sync_every steps.
+def run_actor(epsilon, num_envs, ring_buffer, ring_capacity, board_buffer,
+              shapes, stop, seed = None, sync_every = 50):
+
+    ring = TransitionRing(ring_capacity, buffer = ring_buffer)
+    board = WeightBoard(shapes, board_buffer)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    game_seed, action_seed = seed.spawn(2)
+    rng = np.random.default_rng(action_seed)
+    env = VecSixWinters(num_envs, game_seed)
+
+    weights = None
+    version = 0
+    scores = np.zeros(num_envs, dtype = np.int64)
+    states = env.reset()
+    step = 0
+
+    try:
+        while not stop.is_set():
+
+            if step % sync_every == 0:
+                newer = board.read_newer(version)
+                if newer is not None:
+                    weights, version = newer
+
+            actions = rng.integers(NUM_ACTIONS, size = num_envs)
+            if weights is not None:
+                greedy = rng.random(num_envs) >= epsilon
+                if greedy.any():
+                    actions[greedy] = q_values(weights, states[greedy]).argmax(axis = 1)
+
+            next_states, rewards, dones, info = env.step(actions)
+            ends = next_states.copy()
+            ends[dones] = info['terminal_obs']
+            ring.write(states, actions, rewards, ends, dones)
+
+            scores += rewards
+            ring.header[SCORE] += int(scores[dones].sum())
+            ring.header[GAMES] += int(dones.sum())
+            scores[dones] = 0
+            states = next_states
+            step += 1
+    finally:
+        ring.close()
+        board.close()
+
+# Trains with num_actors actor processes, each playing envs_per_actor games
+# at once, for total_updates updates of batch_size transitions, run
+# updates_per_call at a time. Weights are published to the actors every
+# publish_every updates. Progress shows env steps per second since the
+# start, and updates per second over the time spent training. Returns the
+# trained model.
+def train(num_actors = None, envs_per_actor = 16, total_updates = 100000,
+          batch_size = 32, updates_per_call = 16, publish_every = 400,
+          buffer_size = 1000000, warmup = 10000, ring_capacity = 1 << 16,
+          prioritized = False, target_period = 2000, report_every = 10.0,
+          seed = 0):
+
+    # Actors are spawned rather than forked, so they start clean of the
+    # learner's TensorFlow state
+    context = multiprocessing.get_context('spawn')
+    num_actors = num_actors or max(multiprocessing.cpu_count() - 1, 1)
+    shapes = layer_shapes()
+    board = WeightBoard(shapes, context = context)
+    rings = [TransitionRing(ring_capacity, context = context) for i in range(num_actors)]
+
+    stop = context.Event()
+    seeds = np.random.SeedSequence(seed).spawn(num_actors)
+    actors = [context.Process(target = run_actor,
+                              args = (epsilon, envs_per_actor, rings[i].buffer,
+                                      ring_capacity, board.buffer, shapes, stop,
+                                      seeds[i]),
+                              daemon = True)
+              for i, epsilon in enumerate(actor_epsilons(num_actors))]
+    for actor in actors:
+        actor.start()
+
+    try:
+        import tensorflow as tf
+        import qlearning
+
+        model = qlearning.build_model((OBS_SIZE,), NUM_ACTIONS)
+        assert [w.shape for w in model.get_weights()] == shapes
+        trainer = qlearning.DQNTrainer(model, NUM_ACTIONS, tf.keras.optimizers.Adam(1e-4),
+                                       batch_size = batch_size,
+                                       target_period = target_period)
+        if prioritized:
+            memory = PrioritizedReplayMemory(buffer_size)
+        else:
+            memory = ReplayMemory(buffer_size)
+        board.publish(model.get_weights())
+        published = 0
+
+        start = last_report = time.perf_counter()
+        update_seconds = 0.0
+        loss = 0.0
+        while trainer.updates < total_updates:
+
+            for ring in rings:
+                batch = ring.read_new()
+                if len(batch):
+                    memory.add_batch(batch['state'], batch['action'], batch['reward'],
+                                     batch['next_state'], batch['done'])
+
+            # An actor only stops when told to, so one that has stopped failed
+            if not all(actor.is_alive() for actor in actors):
+                raise RuntimeError('An actor stopped with exit codes '
+                                   f'{[actor.exitcode for actor in actors]}')
+
+            if len(memory) < warmup:
+                time.sleep(0.01)
+                continue
+
+            update_start = time.perf_counter()
+            loss = trainer.train(memory, updates_per_call)
+            update_seconds += time.perf_counter() - update_start
+            if trainer.updates - published >= publish_every:
+                board.publish(model.get_weights())
+                published = trainer.updates
+
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                last_report = now
+                elapsed = now - start
+                steps = sum(int(ring.header[WRITTEN]) for ring in rings)
+                games = sum(int(ring.header[GAMES]) for ring in rings)
+                score = sum(int(ring.header[SCORE]) for ring in rings)
+                dropped = sum(ring.dropped for ring in rings)
+                print(f'{steps} steps, {steps / elapsed:.0f} steps/sec, '
+                      f'{dropped} dropped, {trainer.updates} updates, '
+                      f'{trainer.updates / max(update_seconds, 1e-9):.0f} '
+                      f'updates/sec, loss {loss:.4f}, '
+                      f'mean score {score / max(games, 1):.3f}', flush = True)
+
+        return model
+
+    finally:
+        stop.set()
+        for actor in actors:
+            actor.join()
+        for shared in [board] + rings:
+            shared.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Train a DQN with actor '
+                                     'processes feeding a learner.')
+    parser.add_argument('--actors', type = int, default = None)
+    parser.add_argument('--envs-per-actor', type = int, default = 16)
+    parser.add_argument('--updates', type = int, default = 100000)
+    parser.add_argument('--prioritized', action = 'store_true')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--save', default = None, help = 'save the model here')
+    args = parser.parse_args()
+
+    model = train(args.actors, args.envs_per_actor, args.updates,
+                  prioritized = args.prioritized, seed = args.seed)
+    if args.save:
+        model.save(args.save)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the hot paths of the Six Winters engine. Running this file
+prints the results of each benchmark.
+"""
+
+import bisect
+import copy
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+from resource import Resource, ResourcePool, roll_die
+from sixwinters import SixWinters
+
+# Calls fn the given number of times, returning calls per second
+def rate(fn, number):
+    start = time.perf_counter()
+    for i in range(number):
+        fn()
+    return number / (time.perf_counter() - start)
+
+# Runs fn, returning its result along with the memory it left allocated,
+# the peak memory during the call, and the number of gen 0 collections
+def traced(fn):
+    gc.collect()
+    collections = gc.get_stats()[0]['collections']
+    tracemalloc.start()
+    result = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    collections = gc.get_stats()[0]['collections'] - collections
+    return result, current, peak, collections
+
+# A die the way they were before interning, a new object with a __dict__
+# for every roll, kept in sorted lists
+class _DictDie:
+
+    def __init__(self, resource_type):
+        self.resource_type = resource_type
+        self.value = random.randint(1, 6)
+
+    def __lt__(self, other):
+        return self.value < other.value
+
+def _dict_pool(pool_size):
+    return sorted(_DictDie(Resource.ORE) for i in range(pool_size))
+
+# Take the lowest and highest dice out of a pool, then refill it
+def _dict_cycle(pool):
+    pool.pop()
+    pool.pop(0)
+    while len(pool) < 5:
+        bisect.insort_left(pool, _DictDie(Resource.ORE))
+
+def _interned_cycle(pool):
+    pool.remove(pool.lowest_die())
+    pool.remove(pool.highest_die_under(6))
+    pool.refill()
+
+def benchmark_dice(num_pools = 20000, cycles = 200000):
+
+    print('--- Resource dice ---')
+    die = _DictDie(Resource.ORE)
+    print('Bytes per die: dict', sys.getsizeof(die) + sys.getsizeof(die.__dict__),
+          'interned', sys.getsizeof(roll_die(Resource.ORE)), '(shared by all pools)')
+
+    for name, build in [('dict', lambda: [_dict_pool(5) for i in range(num_pools)]),
+                        ('interned', lambda: [ResourcePool(Resource.ORE, 5)
+                                              for i in range(num_pools)])]:
+        pools, current, peak, collections = traced(build)
+        print(f'{name:>8}: {current // num_pools} bytes per full pool')
+
+    for name, pool, cycle in [('dict', _dict_pool(5), _dict_cycle),
+                              ('interned', ResourcePool(Resource.ORE, 5),
+                               _interned_cycle)]:
+        per_sec, current, peak, collections = traced(lambda: rate(lambda: cycle(pool),
+                                                                  cycles))
+        print(f'{name:>8}: {int(per_sec)} refills/sec, {collections} gen 0 '
+              f'collections, {peak} bytes peak over {cycles} refills')
+
+def benchmark_state(number = 100000):
+
+    print('--- Game snapshots ---')
+    env = SixWinters()
+    env.reset()
+    for action in [4, 1, 6]:
+        env.step(action)
+
+    for with_rng in [False, True]:
+        state = env.get_state(with_rng)
+        get_rate = rate(lambda: env.get_state(with_rng), number)
+        set_rate = rate(lambda: env.set_state(state), number)
+        round_trip = rate(lambda: env.set_state(env.get_state(with_rng)), number)
+        print(f'with_rng={with_rng}: get {1e6 / get_rate:.2f} us, '
+              f'set {1e6 / set_rate:.2f} us, round trip {1e6 / round_trip:.2f} us')
+
+    deepcopy_rate = rate(lambda: copy.deepcopy(env), number // 100)
+    print(f'copy.deepcopy: {1e6 / deepcopy_rate:.2f} us')
+
+def benchmark_hash(number = 100000):
+
+    print('--- State hashing ---')
+    env = SixWinters()
+    env.reset()
+    for action in [4, 1, 6]:
+        env.step(action)
+
+    obs_rate = rate(lambda: hash(tuple(env._get_obs().tolist())), number)
+    zobrist_rate = rate(lambda: env.state_hash, number)
+    print(f'hash of obs: {1e6 / obs_rate:.2f} us, '
+          f'state_hash: {1e6 / zobrist_rate:.2f} us')
+
+# Actions per second picking actions with model.predict, one step at a
+# time, against the compiled batched policy over VecSixWinters games. Both
+# include the time to step the games.
+def benchmark_acting(steps = 2000, batch_sizes = (1, 16, 256)):
+
+    import qlearning
+    from vec_env import VecSixWinters
+
+    print('--- Acting ---')
+    env = SixWinters()
+    num_actions = env.action_space.n
+    model = qlearning.build_model(env.observation_space.shape, num_actions)
+
+    obs = env.reset()
+    start = time.perf_counter()
+    for step in range(steps // 10):
+        action = qlearning.epsilon_greedy_policy(model, obs, num_actions)
+        obs, reward, done, info = env.step(action)
+        if done:
+            obs = env.reset()
+    print(f'model.predict per step: '
+          f'{steps // 10 / (time.perf_counter() - start):.0f} actions/sec')
+
+    greedy_actions = qlearning.greedy_action_function(model)
+    for num_envs in batch_sizes:
+        vec = VecSixWinters(num_envs, seed = 0)
+        obs = vec.reset()
+        qlearning.batched_epsilon_greedy_policy(greedy_actions, obs, num_actions)
+        start = time.perf_counter()
+        for step in range(steps):
+            actions = qlearning.batched_epsilon_greedy_policy(greedy_actions, obs,
+                                                              num_actions, 0.05)
+            obs, rewards, dones, info = vec.step(actions)
+        elapsed = time.perf_counter() - start
+        print(f'compiled, {num_envs} games: '
+              f'{num_envs * steps / elapsed:.0f} actions/sec')
+
+# DQN updates per second for the old train function, one update per call,
+# against DQNTrainer running K updates per compiled call
+def benchmark_updates(calls = 50, batch_sizes = (1, 16, 64)):
+
+    import tensorflow as tf
+    import qlearning
+    from replay import ReplayMemory
+    from vec_env import VecSixWinters
+
+    print('--- DQN updates ---')
+    vec = VecSixWinters(64, seed = 0)
+    num_actions = vec.action_space.n
+    replay_buffer = ReplayMemory(10000)
+    obs = vec.reset()
+    for step in range(100):
+        obs, rewards, dones, info, replay_buffer = qlearning.play_vec_step(
+            replay_buffer, None, num_actions, vec, obs, 1.0)
+
+    model = qlearning.build_model(vec.observation_space.shape, num_actions)
+    optimizer = tf.keras.optimizers.Adam(1e-4)
+    qlearning.train(model, num_actions, replay_buffer, optimizer)
+    start = time.perf_counter()
+    for call in range(calls):
+        qlearning.train(model, num_actions, replay_buffer, optimizer)
+    print(f'train: {calls / (time.perf_counter() - start):.0f} updates/sec')
+
+    trainer = qlearning.DQNTrainer(model, num_actions, optimizer)
+    for k in batch_sizes:
+        trainer.train(replay_buffer, k)
+        start = time.perf_counter()
+        for call in range(calls):
+            trainer.train(replay_buffer, k)
+        print(f'DQNTrainer, {k} per call: '
+              f'{calls * k / (time.perf_counter() - start):.0f} updates/sec')
+
+if __name__ == "__main__":
+
+    benchmark_dice()
+    benchmark_state()
+    benchmark_hash()
+
+    try:
+        import tensorflow
+    except ImportError:
+        print('TensorFlow is not installed, skipping the acting and update benchmarks')
+    else:
+        benchmark_acting()
+        benchmark_updates()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how complex the decision space of Six Winters is, by walking the
+game tree out from a sample of starting boards. For each depth it reports
+the number of distinct states reached, how many distinct states follow
+from each state once the dice are rolled (the effective branching factor),
+and how many of the actions lead to meaningfully different results.
+
+The walk works with any version of the game: run it with --game pointing at
+the v01, v02 or v03 directory. v03 snapshots games with get_state and can
+enumerate every way the pools refill exactly. Earlier versions are copied
+with deepcopy, and the dice are sampled, which makes their counts lower
+bounds.
+
+States are kept in a set of hashes, and when a depth has more states than
+can be expanded, a uniform sample of them is expanded instead. In v03 the
+hash is env.state_hash, which leaves out the order of the achievement deck,
+so states are counted as the player sees them. reachable.py keeps the order
+of the deck, and counts more states.
+"""
+
+import argparse
+import copy
+import itertools
+import os
+import random
+import sys
+import time
+
+# Loads the SixWinters environment from one of the game directories. This
+# has to happen before any other game module is imported.
+def load_game(directory):
+    sys.path.insert(0, os.path.abspath(directory))
+    import sixwinters
+    return sixwinters.SixWinters
+
+# Finished games all look the same to the walk, whatever is left on the
+# board, so they're told apart only by how many achievements are left
+def _finished_key(env):
+    return ('done', len(env.achievement_deck.cards) + len(env.current_achievements))
+
+# Drives one environment through the tree, hiding the differences between
+# versions of the game
+class GameWalker:
+
+    def __init__(self, env_class, exact = True):
+        self.env = env_class()
+        self.snapshots = hasattr(self.env, 'get_state')
+        self.exact = exact and hasattr(self.env, '_play')
+        if self.exact:
+            from solver import roll_outcomes
+            self._roll_outcomes = [roll_outcomes(n)
+                                   for n in range(self.env.config.resource_pool_size + 1)]
+
+    @property
+    def num_actions(self):
+        return self.env.action_space.n
+
+    def start(self, seed):
+        random.seed(seed)
+        if hasattr(self.env, 'roller'):
+            self.env.seed(seed)
+        self.env.reset()
+
+    def snapshot(self):
+        if self.snapshots:
+            return self.env.get_state(False)
+        return copy.deepcopy(self.env)
+
+    def restore(self, snapshot):
+        if self.snapshots:
+            self.env.set_state(snapshot)
+        else:
+            self.env = copy.deepcopy(snapshot)
+
+    # Seeds the dice for the next step
+    def reseed(self, seed):
+        random.seed(seed)
+        if hasattr(self.env, 'roller'):
+            self.env.roller.reseed(seed)
+
+    def key(self):
+        env = self.env
+        if env.done:
+            return _finished_key(env)
+        if hasattr(env, 'state_hash'):
+            return env.state_hash
+        deck = tuple(sorted(str(a) for a in env.achievement_deck.cards))
+        return hash((tuple(env._get_obs()), env.timers, deck))
+
+    # The successors of a state for one action, as a list of (key, snapshot)
+    # with a snapshot of None for finished games, and a key for the result
+    # of the action before any dice are rolled. Sampled successors use the
+    # same seeds for every action.
+    def successors(self, snapshot, action, samples, seed):
+
+        if self.exact:
+            return self._exact_successors(snapshot, action)
+
+        results = []
+        outcome = []
+        for sample in range(samples):
+            self.restore(snapshot)
+            self.reseed(seed + sample)
+            self.env.step(action)
+            key = self.key()
+            outcome.append(key)
+            results.append((key, None if self.env.done else self.snapshot()))
+        return results, tuple(outcome)
+
+    # Every way the pools could be refilled after the action
+    def _exact_successors(self, snapshot, action):
+
+        env = self.env
+        self.restore(snapshot)
+        env._play(action)
+        if env.done:
+            return [(_finished_key(env), None)], _finished_key(env)
+        outcome = env.state_hash
+        state = env.get_state(False)._replace(obs = None)
+
+        size = env.config.resource_pool_size
+        missing = [(i, size - sum(counts)) for i, counts in enumerate(state.pools)
+                   if sum(counts) < size]
+
+        results = []
+        for rolls in itertools.product(*[self._roll_outcomes[n] for i, n in missing]):
+            pools = list(state.pools)
+            for (i, n), (counts, p) in zip(missing, rolls):
+                pools[i] = tuple([a + b for a, b in zip(pools[i], counts)])
+            env.set_state(state._replace(pools = tuple(pools)))
+            results.append((env.state_hash, env.get_state(False)))
+
+        return results, outcome
+
+# Statistics for one depth of the walk
+class DepthStats:
+
+    def __init__(self, depth, num_actions):
+        self.depth = depth
+        self.num_actions = num_actions
+        self.states = 0
+        self.lower_bound = False
+        self.expanded = 0
+        self.finished = 0
+        self.successors = 0
+        self.action_successors = 0
+        self.meaningful_actions = 0
+
+    def __str__(self):
+        expanded = max(self.expanded, 1)
+        states = ('>=' if self.lower_bound else '') + str(self.states)
+        return (f'{self.depth:>5} {states:>10} {self.expanded:>9} '
+                f'{self.successors / expanded:>10.1f} '
+                f'{self.action_successors / expanded / self.num_actions:>12.1f} '
+                f'{self.meaningful_actions / expanded:>10.2f} '
+                f'{self.finished:>9}')
+
+HEADER = (f'{"depth":>5} {"states":>10} {"expanded":>9} {"branching":>10} '
+          f'{"per action":>12} {"actions":>10} {"finished":>9}')
+
+# Walks max_depth turns out from num_starts starting boards. Each depth
+# expands at most max_states states, picked at random if there are more,
+# in which case the states counted at the next depth are a lower bound.
+# When the dice are sampled rather than enumerated, the counts after the
+# starting boards are always lower bounds.
+# Returns a DepthStats for each depth.
+def analyze(env_class, max_depth = 3, num_starts = 10, max_states = 2000,
+            samples = 16, exact = True, seed = 0, log = None):
+
+    walker = GameWalker(env_class, exact)
+    rng = random.Random(seed)
+
+    frontier = {}
+    for start in range(num_starts):
+        walker.start(seed + start)
+        frontier[walker.key()] = walker.snapshot()
+    num_states = len(frontier)
+    frontier = list(frontier.values())
+    lower_bound = False
+
+    results = []
+    for depth in range(max_depth + 1):
+
+        stats = DepthStats(depth, walker.num_actions)
+        stats.states = num_states
+        stats.lower_bound = lower_bound
+        results.append(stats)
+
+        expand = frontier
+        if not walker.exact or num_states > len(expand) or len(expand) > max_states:
+            lower_bound = True
+        if len(expand) > max_states:
+            expand = rng.sample(expand, max_states)
+
+        # Count every state at the next depth, but only keep a uniform
+        # sample of them (a reservoir sample) to expand
+        seen = set()
+        kept = []
+        unfinished = 0
+        for snapshot in expand:
+
+            stats.expanded += 1
+            chance_seed = rng.randrange(1 << 30)
+            found = set()
+            outcomes = set()
+            for action in range(walker.num_actions):
+                successors, outcome = walker.successors(snapshot, action, samples,
+                                                        chance_seed)
+                outcomes.add(outcome)
+                action_keys = set()
+                for key, successor in successors:
+                    action_keys.add(key)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    if successor is None:
+                        stats.finished += 1
+                        continue
+                    unfinished += 1
+                    if len(kept) < max_states:
+                        kept.append(successor)
+                    else:
+                        replace = rng.randrange(unfinished)
+                        if replace < max_states:
+                            kept[replace] = successor
+                stats.action_successors += len(action_keys)
+                found |= action_keys
+            stats.successors += len(found)
+            stats.meaningful_actions += len(outcomes)
+
+        if log is not None:
+            print(stats, file = log, flush = True)
+
+        # Finished games aren't walked any further
+        frontier = kept
+        num_states = unfinished
+        if not frontier:
+            break
+
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Measure the branching factor '
+                                     'and reachable states of Six Winters.')
+    parser.add_argument('--game', default = os.path.dirname(os.path.abspath(__file__)),
+                        help = 'the game directory to analyze, e.g. v01')
+    parser.add_argument('--depth', type = int, default = 3)
+    parser.add_argument('--starts', type = int, default = 10,
+                        help = 'number of random starting boards')
+    parser.add_argument('--max-states', type = int, default = 2000,
+                        help = 'most states expanded at each depth')
+    parser.add_argument('--samples', type = int, default = 16,
+                        help = 'dice rolls sampled per action, when not exact')
+    parser.add_argument('--sampled', action = 'store_true',
+                        help = 'sample the dice even when they can be enumerated')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    env_class = load_game(args.game)
+
+    print(f'Game {args.game}')
+    print('states: distinct states reached, branching: distinct states after '
+          'a turn, per action: the same for each action, actions: actions with '
+          'different results before the dice are rolled')
+    print(HEADER)
+    start = time.perf_counter()
+    analyze(env_class, args.depth, args.starts, args.max_states, args.samples,
+            not args.sampled, args.seed, sys.stdout)
+    print(f'{time.perf_counter() - start:.1f} sec')
@@ -5,13 +5,14 @@ Created on Sun Aug 30 09:16:54 2020
 @author: phill
 """
 
-from random import shuffle
+from resource import default_roller
 
 class Deck:
     
-    def __init__(self, cards):
+    def __init__(self, cards, roller = default_roller):
         self.cards = cards
-        shuffle(self.cards)
+        self.roller = roller
+        self.shuffle()
 
     # Pull a card from the deck
     def draw(self):
@@ -23,5 +24,9 @@ class Deck:
     def insert(self, card):
         self.cards.append(card)
     
+    # Fisher-Yates shuffle using the deck's roller
     def shuffle(self):
-        shuffle(self.cards)
\ No newline at end of file
+        cards = self.cards
+        for i in range(len(cards) - 1, 0, -1):
+            j = self.roller.randrange(i + 1)
+            cards[i], cards[j] = cards[j], cards[i]
\ No newline at end of file
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Estimates how well a policy plays Six Winters by playing it over and over
+across a pool of processes, stopping once the confidence interval of the
+completion rate is narrow enough.
+
+Games are played in chunks, and each chunk is seeded from the master seed
+and its index, so the result only depends on the master seed and chunk
+size, not on the number of processes or which one played each chunk.
+"""
+
+import argparse
+import collections
+import multiprocessing
+import time
+from math import sqrt
+
+import numpy as np
+
+from sixwinters import SixWinters
+from rules import DEFAULT_RULES
+from store import ResultStore, policy_digest, result_key
+
+# The z score for a 95% confidence interval
+Z_95 = 1.959964
+
+# A policy is called with the observation and the environment, and returns
+# an action. Policies are sent to worker processes, so must be picklable,
+# e.g. a function defined at the top level of a module.
+def random_policy(obs, env):
+    return env.roller.randrange(env.action_space.n)
+
+# Counts from playing games, which add together across chunks. scores[s] is
+# the number of games scoring s, and completion_turns[a][t] the number of
+# games completing achievement a on turn t, with t = 0 for never.
+class Tally:
+
+    def __init__(self, config):
+        num_achievements = len(config.achievements)
+        self.games = 0
+        self.scores = np.zeros(num_achievements + 1, dtype = np.int64)
+        self.completion_turns = np.zeros((num_achievements, config.max_timers + 1),
+                                         dtype = np.int64)
+
+    def add(self, other):
+        self.games += other.games
+        self.scores += other.scores
+        self.completion_turns += other.completion_turns
+
+    # Plain lists, to save in a ResultStore
+    def to_dict(self):
+        return {'games': self.games, 'scores': self.scores.tolist(),
+                'completion_turns': self.completion_turns.tolist()}
+
+    @classmethod
+    def from_dict(cls, config, counts):
+        tally = cls(config)
+        tally.games = counts['games']
+        tally.scores[:] = counts['scores']
+        tally.completion_turns[:] = counts['completion_turns']
+        return tally
+
+# Looks up a chunk in a store, returning its Tally or None
+def stored_chunk(store, config, policy_id, master_seed, chunk, chunk_size):
+    counts = store.get(result_key(config, policy_id, master_seed, chunk, chunk_size))
+    if counts is None:
+        return None
+    return Tally.from_dict(config, counts)
+
+def store_chunk(store, tally, config, policy_id, master_seed, chunk, chunk_size):
+    store.put(result_key(config, policy_id, master_seed, chunk, chunk_size),
+              tally.to_dict(), config, policy_id, master_seed, chunk, chunk_size)
+
+# Each worker builds an environment for each set of rules it is given once,
+# then reseeds it for every chunk
+_worker_envs = {}
+_worker_policy = None
+
+def _init_worker(policy):
+    global _worker_policy
+    _worker_policy = policy
+
+def _worker_env(config):
+    env = _worker_envs.get(config)
+    if env is None:
+        env = _worker_envs[config] = SixWinters(config = config)
+    return env
+
+def chunk_seed(master_seed, chunk):
+    return np.random.SeedSequence(master_seed, spawn_key = (chunk,))
+
+# Plays a chunk of games, returning their Tally. In a worker process the
+# policy is the one the pool was started with.
+def play_chunk(master_seed, chunk, chunk_size, config = DEFAULT_RULES,
+               policy = None):
+
+    env = _worker_env(config)
+    policy = policy or _worker_policy
+    env.seed(chunk_seed(master_seed, chunk))
+
+    num_achievements = len(env.achievements)
+    tally = Tally(config)
+
+    for game in range(chunk_size):
+        obs = env.reset()
+        score = 0
+        done = False
+        completed = [0] * num_achievements
+        while not done:
+            obs, reward, done, info = env.step(policy(obs, env))
+            score += reward
+            for i in info['completed']:
+                completed[i] = env.timers
+        tally.games += 1
+        tally.scores[score] += 1
+        for i, turn in enumerate(completed):
+            tally.completion_turns[i, turn] += 1
+
+    return tally
+
+# The Wilson score interval for a proportion, which stays sensible when
+# there are few games or the rate is close to 0 or 1
+def wilson_interval(successes, n, z = Z_95):
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / denominator
+    half = z * sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+# The mean and its normal confidence interval, from counts of each value
+def mean_interval(counts, z = Z_95):
+    n = counts.sum()
+    values = np.arange(len(counts))
+    mean = (values * counts).sum() / n
+    variance = ((values - mean) ** 2 * counts).sum() / max(n - 1, 1)
+    half = z * sqrt(variance / n)
+    return mean, (mean - half, mean + half)
+
+Estimate = collections.namedtuple('Estimate', ['games', 'score_distribution',
+                                               'mean_score', 'score_interval',
+                                               'completion_rate',
+                                               'completion_interval',
+                                               'completion_turns',
+                                               'mean_completion_turn',
+                                               'achievement_rates'])
+
+# Summarizes a Tally. completion_turns maps each achievement, named by its
+# index and rule so achievements with the same rule are kept apart, to the
+# fraction of games it was completed on each turn (1 to max_timers), and
+# mean_completion_turn to the mean turn over the games it was completed in.
+def summarize(tally, achievements):
+
+    games = tally.games
+    completions = tally.scores[-1]
+    turns = np.arange(tally.completion_turns.shape[1])
+
+    completion_turns = {}
+    mean_completion_turn = {}
+    achievement_rates = {}
+    for i, (achievement, counts) in enumerate(zip(achievements, tally.completion_turns)):
+        name = f'{i}: {achievement}'
+        completed = counts[1:].sum()
+        completion_turns[name] = counts[1:] / games
+        mean_completion_turn[name] = ((turns * counts).sum() / completed
+                                      if completed else None)
+        achievement_rates[name] = completed / games
+
+    mean_score, score_interval = mean_interval(tally.scores)
+
+    return Estimate(games, tally.scores / games, mean_score, score_interval,
+                    completions / games, wilson_interval(completions, games),
+                    completion_turns, mean_completion_turn, achievement_rates)
+
+# Plays a policy until the 95% confidence interval of the completion rate
+# is narrower than width, or max_games have been played. Chunks are
+# collected in order, with enough queued to keep every process busy, so
+# stopping is decided the same way however many processes there are.
+#
+# With a ResultStore, chunks which have been played before are read from
+# it instead of being played again, and new chunks are saved to it.
+def estimate(policy = random_policy, master_seed = 0, width = 0.01,
+             processes = None, chunk_size = 500, min_games = 1000,
+             max_games = 10000000, config = DEFAULT_RULES, store = None):
+
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes, _init_worker, (policy,)) as pool:
+        return estimate_with_pool(pool, processes, config, master_seed, width,
+                                  chunk_size, min_games, max_games, store,
+                                  policy_digest(policy))
+
+# Runs an estimate on a pool started with _init_worker, so one pool can
+# estimate many sets of rules in turn. Chunks still queued when the
+# estimate stops are left to finish and their results dropped, apart from
+# any already finished, which are saved to the store. Using a store needs
+# policy_id, the policy_digest of the pool's policy.
+def estimate_with_pool(pool, processes, config = DEFAULT_RULES, master_seed = 0,
+                       width = 0.01, chunk_size = 500, min_games = 1000,
+                       max_games = 10000000, store = None, policy_id = None):
+
+    achievements = SixWinters(config = config).achievements
+    tally = Tally(config)
+
+    # Each pending chunk is its index and either its stored Tally, or the
+    # result of playing it
+    pending = collections.deque()
+    chunk = 0
+
+    while True:
+
+        while len(pending) < 2 * processes:
+            stored = None
+            if store is not None:
+                stored = stored_chunk(store, config, policy_id, master_seed,
+                                      chunk, chunk_size)
+            if stored is None:
+                stored = pool.apply_async(play_chunk, (master_seed, chunk,
+                                                       chunk_size, config))
+            pending.append((chunk, stored))
+            chunk += 1
+
+        done, result = pending.popleft()
+        if not isinstance(result, Tally):
+            result = result.get()
+            if store is not None:
+                store_chunk(store, result, config, policy_id, master_seed, done,
+                            chunk_size)
+        tally.add(result)
+
+        low, high = wilson_interval(tally.scores[-1], tally.games)
+        if ((tally.games >= min_games and high - low < width) or
+            tally.games >= max_games):
+            break
+
+    # Chunks played past the stopping point aren't counted, but are worth
+    # keeping for a later estimate that needs more games
+    if store is not None:
+        for done, result in pending:
+            if not isinstance(result, Tally) and result.ready():
+                store_chunk(store, result.get(), config, policy_id, master_seed,
+                            done, chunk_size)
+
+    return summarize(tally, achievements)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Estimate how often a random '
+                                     'policy completes every achievement.')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--width', type = float, default = 0.01,
+                        help = 'target width of the 95%% confidence interval')
+    parser.add_argument('--processes', type = int, default = None)
+    parser.add_argument('--chunk-size', type = int, default = 500)
+    parser.add_argument('--store', default = None,
+                        help = 'reuse and save results in this SQLite file')
+    args = parser.parse_args()
+
+    store = ResultStore(args.store) if args.store else None
+
+    start = time.perf_counter()
+    result = estimate(random_policy, args.seed, args.width, args.processes,
+                      args.chunk_size, store = store)
+    elapsed = time.perf_counter() - start
+
+    if store is not None:
+        print('Store', store.stats())
+        store.close()
+
+    print(f'{result.games} games in {elapsed:.1f} sec, '
+          f'{result.games / elapsed:.0f} games/sec')
+    print(f'Completion rate {result.completion_rate:.4f} '
+          f'({result.completion_interval[0]:.4f} - {result.completion_interval[1]:.4f})')
+    print(f'Mean score {result.mean_score:.3f} '
+          f'({result.score_interval[0]:.3f} - {result.score_interval[1]:.3f})')
+    print('Score distribution', np.round(result.score_distribution, 4))
+    for name, rate in result.achievement_rates.items():
+        turn = result.mean_completion_turn[name]
+        print(f'{name}: completed {rate:.4f}, mean turn '
+              f'{"never" if turn is None else f"{turn:.2f}"}')
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Perfect hashes of Six Winters states: maps the dice in a pool or location,
+and whole game states and observations, to dense integer indices and back,
+so plain NumPy arrays can be used as value tables, visit counts or policy
+tables in place of dicts keyed by tuples.
+
+The dice in a pool are a multiset of up to n faces. Padding it out to
+exactly n with a seventh "no die" face and adding i to the i-th smallest
+value turns it into a combination of n from n + 6, which the combinatorial
+number system ranks densely: a pool of up to 5 dice has 462 indices, and a
+location of up to 3 dice has 84. Whole states combine the index of each
+part as the digits of a mixed radix number.
+
+Every function works on whole batches at once.
+"""
+
+import itertools
+import time
+
+from functools import lru_cache
+
+import numpy as np
+
+from achievement import AchievementType
+from resource import Resource
+from rules import DEFAULT_RULES
+from sixwinters import GameState
+
+FACES = 6
+
+# BINOMIAL[n, k] is n choose k, for the sizes the dice need
+MAX_BINOMIAL = 32
+BINOMIAL = np.zeros((MAX_BINOMIAL + 1, MAX_BINOMIAL + 1), dtype = np.int64)
+for n in range(MAX_BINOMIAL + 1):
+    BINOMIAL[n, 0] = 1
+    for k in range(1, n + 1):
+        BINOMIAL[n, k] = BINOMIAL[n - 1, k - 1] + BINOMIAL[n - 1, k]
+
+INT64_LIMIT = np.iinfo(np.int64).max
+
+# The number of ways to hold up to max_dice dice
+def num_multisets(max_dice):
+    return int(BINOMIAL[max_dice + FACES, FACES])
+
+# The sorted face of each die, from 0, for counts of each face, with FACES
+# padding out the places past the last die. counts has shape (..., 6), and
+# the result (..., max_dice).
+def sorted_faces(counts, max_dice):
+    ends = np.asarray(counts).cumsum(axis = -1)
+    places = np.arange(max_dice)
+    return (ends[..., None, :] <= places[:, None]).sum(axis = -1)
+
+# The index of up to max_dice dice, given as counts of each face
+def encode_counts(counts, max_dice):
+    places = np.arange(max_dice)
+    return BINOMIAL[sorted_faces(counts, max_dice) + places, places + 1].sum(axis = -1)
+
+# The counts of each face for indices from encode_counts
+def decode_counts(index, max_dice):
+    index = np.array(index, dtype = np.int64)
+    faces = np.empty(index.shape + (max_dice,), dtype = np.int64)
+    for k in range(max_dice, 0, -1):
+        column = BINOMIAL[:max_dice + FACES, k]
+        c = np.searchsorted(column, index, side = 'right') - 1
+        faces[..., k - 1] = c - (k - 1)
+        index -= column[c]
+    return (faces[..., None] == np.arange(FACES)).sum(axis = -2)
+
+# Counts of each face for dice encoded as in an observation: values 1 to 6,
+# with 0 for no die
+def dice_counts(dice):
+    return (np.asarray(dice)[..., None] == np.arange(1, FACES + 1)).sum(axis = -2)
+
+# The dice of an observation for counts of each face, padded to slots
+def counts_dice(counts, slots):
+    faces = sorted_faces(counts, slots)
+    return np.where(faces < FACES, faces + 1, 0)
+
+# Every ordering of up to max_length of n items, shortest first, along with
+# a table from each one, as the digits of a base n + 1 number with n as
+# padding, to its index
+@lru_cache(maxsize = None)
+def sequence_table(n, max_length):
+    sequences = np.full((0, max_length), n, dtype = np.int64)
+    for length in range(max_length + 1):
+        found = list(itertools.permutations(range(n), length))
+        found = np.array(found, dtype = np.int64).reshape(len(found), length)
+        padded = np.full((len(found), max_length), n, dtype = np.int64)
+        padded[:, :length] = found
+        sequences = np.concatenate([sequences, padded])
+    powers = (n + 1) ** np.arange(max_length)
+    lookup = np.full((n + 1) ** max_length, -1, dtype = np.int64)
+    lookup[sequences @ powers] = np.arange(len(sequences))
+    return sequences, lookup, powers
+
+# The number of values mixed radix numbers can take, as a Python int so it
+# doesn't overflow
+def radix_product(radices):
+    size = 1
+    for radix in radices:
+        size *= int(radix)
+    return size
+
+# Joins the digits of mixed radix numbers, most significant first. Numbers
+# which don't fit in 64 bits are Python ints in an object array.
+def combine(digits, radices):
+    size = radix_product(radices)
+    index = np.zeros(len(digits[0]), dtype = np.int64 if size <= INT64_LIMIT else object)
+    for digit, radix in zip(digits, radices):
+        index = index * radix + np.asarray(digit).astype(index.dtype)
+    return index
+
+def split(index, radices):
+    index = np.asarray(index)
+    digits = []
+    for radix in reversed(radices):
+        digits.append((index % radix).astype(np.int64))
+        index = index // radix
+    return digits[::-1]
+
+# Dense indices for the states and observations of one set of rules. A
+# state is its pools, locations, where each character is, the order of the
+# achievements left (visible ones first, then the deck) and the timers.
+# An observation has no timers or deck, so only the visible achievements.
+# Characters at the same location are taken in order of index, as with
+# state_hash. Achievements with the same rule look the same in an
+# observation, so they are matched to indices in order, and observation
+# indices with them the other way around are never used. When there are
+# more indices than fit in 64 bits, as with the default rules, indices are
+# Python ints in object arrays.
+class StateIndexer:
+
+    def __init__(self, config = DEFAULT_RULES):
+        self.config = config
+        self.num_pools = len(Resource)
+        self.num_locations = len(config.locations)
+        self.num_characters = len(config.characters)
+        self.num_achievements = len(config.achievements)
+        self.pool_dice = config.resource_pool_size
+        self.location_dice = config.location_pool_size
+
+        character_radices = [self.num_locations] * self.num_characters
+        self._part_radices = ([num_multisets(self.pool_dice)] * self.num_pools +
+                              [num_multisets(self.location_dice)] * self.num_locations +
+                              character_radices)
+        self._deck = sequence_table(self.num_achievements, self.num_achievements)
+        self._visible = sequence_table(self.num_achievements,
+                                       config.num_visible_achievements)
+
+        self.state_radices = self._part_radices + [len(self._deck[0]),
+                                                   config.max_timers + 1]
+        self.obs_radices = self._part_radices + [len(self._visible[0])]
+
+        # What each achievement looks like in an observation
+        self._achievement_codes = np.array([[AchievementType.SUM.value,
+                                              rule.resource_type.value, rule.total]
+                                            for rule in config.achievements])
+        self._cids = np.array([rule.cid for rule in config.characters])
+
+    @property
+    def num_states(self):
+        return radix_product(self.state_radices)
+
+    @property
+    def num_observations(self):
+        return radix_product(self.obs_radices)
+
+    def _parts(self, pools, locations, positions):
+        return ([encode_counts(pools[:, p], self.pool_dice)
+                 for p in range(self.num_pools)] +
+                [encode_counts(locations[:, l], self.location_dice)
+                 for l in range(self.num_locations)] +
+                [positions[:, c] for c in range(self.num_characters)])
+
+    # The index of each sequence of achievements in a table, which has to be
+    # a valid sequence, with no achievement twice
+    def _sequence_index(self, table, sequences):
+        found, lookup, powers = table
+        index = lookup[sequences @ powers]
+        if (index < 0).any():
+            raise ValueError(f'Not a sequence of distinct achievements: '
+                             f'{sequences[index < 0][0].tolist()}')
+        return index
+
+    # The index of each GameState in a list
+    def encode_states(self, states):
+        padding = self.num_achievements
+        pools = np.array([state.pools for state in states])
+        locations = np.array([state.locations for state in states])
+        positions = np.zeros((len(states), self.num_characters), dtype = np.int64)
+        order = np.full((len(states), padding), padding, dtype = np.int64)
+        timers = np.array([state.timers for state in states])
+        for i, state in enumerate(states):
+            for location, characters in enumerate(state.characters):
+                positions[i, list(characters)] = location
+            left = state.achievements + state.deck
+            order[i, :len(left)] = left
+
+        digits = self._parts(pools, locations, positions)
+        digits += [self._sequence_index(self._deck, order), timers]
+        return combine(digits, self.state_radices)
+
+    # The GameState for each index, without an observation or random state.
+    # Visible achievements are the first of the achievements left.
+    def decode_states(self, index):
+        digits = split(index, self.state_radices)
+        pools = np.stack([decode_counts(d, self.pool_dice)
+                          for d in digits[:self.num_pools]], axis = 1)
+        locations = np.stack([decode_counts(d, self.location_dice)
+                              for d in digits[self.num_pools:-2 - self.num_characters]],
+                             axis = 1)
+        positions = np.stack(digits[-2 - self.num_characters:-2], axis = 1)
+        orders = self._deck[0][digits[-2]]
+        visible = self.config.num_visible_achievements
+
+        states = []
+        for i in range(len(pools)):
+            left = tuple([int(a) for a in orders[i] if a != self.num_achievements])
+            timers = int(digits[-1][i])
+            states.append(GameState(
+                tuple([tuple(counts) for counts in pools[i].tolist()]),
+                tuple([tuple(counts) for counts in locations[i].tolist()]),
+                tuple([tuple([c for c in range(self.num_characters)
+                              if positions[i, c] == location])
+                       for location in range(self.num_locations)]),
+                left[visible:], left[:visible], timers,
+                timers >= self.config.max_timers or not left, None, None))
+        return states
+
+    # The index of each observation in a batch, shape (batch, obs_size)
+    def encode_obs(self, obs):
+        config = self.config
+        obs = np.asarray(obs).astype(np.int64).reshape(-1, config.obs_size)
+        slots = config.dice_slots
+
+        pools = np.stack([dice_counts(obs[:, start + 1:start + 1 + slots])
+                          for start in range(0, config.achievements_offset,
+                                             config.pool_obs_size)], axis = 1)
+
+        starts = [config.locations_offset + l * config.location_obs_size
+                  for l in range(self.num_locations)]
+        locations = np.stack([dice_counts(obs[:, start + 1:start + 1 + slots])
+                              for start in starts], axis = 1)
+
+        positions = np.zeros((len(obs), self.num_characters), dtype = np.int64)
+        for location, start in enumerate(starts):
+            cids = obs[:, start + 1 + slots:start + 1 + slots + self.num_characters]
+            here = (cids[:, :, None] == self._cids).any(axis = 1)
+            positions[here] = location
+
+        # Match each visible achievement to the first with the same encoding
+        # not already matched to an earlier slot, so achievements with the
+        # same rule get distinct indices in order, with empty slots as padding
+        codes = obs[:, config.achievements_offset:config.locations_offset]
+        codes = codes.reshape(len(obs), -1, 3)
+        matches = (codes[:, :, None, :] == self._achievement_codes).all(axis = -1)
+        visible = np.full(matches.shape[:2], self.num_achievements, dtype = np.int64)
+        used = np.zeros((len(obs), self.num_achievements), dtype = bool)
+        rows = np.arange(len(obs))
+        for slot in range(matches.shape[1]):
+            free = matches[:, slot] & ~used
+            found = free.any(axis = 1)
+            choice = free.argmax(axis = 1)
+            visible[found, slot] = choice[found]
+            used[rows[found], choice[found]] = True
+
+        digits = self._parts(pools, locations, positions)
+        digits.append(self._sequence_index(self._visible, visible))
+        return combine(digits, self.obs_radices)
+
+    # The observation for each index, shape (batch, obs_size)
+    def decode_obs(self, index):
+        config = self.config
+        digits = split(index, self.obs_radices)
+        slots = config.dice_slots
+        obs = np.zeros((len(digits[0]), config.obs_size), dtype = np.uint8)
+
+        for p, resource in enumerate(Resource):
+            start = p * config.pool_obs_size
+            obs[:, start] = resource.value
+            obs[:, start + 1:start + 1 + slots] = counts_dice(
+                decode_counts(digits[p], self.pool_dice), slots)
+
+        visible = self._visible[0][digits[-1]]
+        codes = np.concatenate([self._achievement_codes,
+                                np.zeros((1, 3), dtype = np.int64)])
+        obs[:, config.achievements_offset:config.locations_offset] = \
+            codes[visible].reshape(len(obs), -1)
+
+        positions = np.stack(digits[-1 - self.num_characters:-1], axis = 1)
+        for l, rule in enumerate(config.locations):
+            start = config.locations_offset + l * config.location_obs_size
+            obs[:, start] = rule.resource_type.value
+            obs[:, start + 1:start + 1 + slots] = counts_dice(
+                decode_counts(digits[self.num_pools + l], self.location_dice), slots)
+
+            # Characters fill the location's slots in order of index
+            here = positions == l
+            place = here.cumsum(axis = 1) - 1
+            for c in range(self.num_characters):
+                rows = np.nonzero(here[:, c])[0]
+                obs[rows, start + 1 + slots + place[rows, c]] = self._cids[c]
+
+        return obs
+
+if __name__ == "__main__":
+
+    from sixwinters import SixWinters
+
+    for max_dice in (3, 5):
+        print(f'Up to {max_dice} dice: {num_multisets(max_dice)} indices')
+
+    indexer = StateIndexer()
+    print(f'{indexer.num_states:.3e} states, {indexer.num_observations:.3e} observations')
+
+    env = SixWinters()
+    env.seed(0)
+    states = []
+    observations = []
+    obs = env.reset()
+    for i in range(10000):
+        states.append(env.get_state(False))
+        observations.append(np.array(obs))
+        obs, reward, done, info = env.step(env.action_space.sample())
+        if done:
+            obs = env.reset()
+    observations = np.array(observations)
+
+    start = time.perf_counter()
+    index = indexer.encode_obs(observations)
+    elapsed = time.perf_counter() - start
+    decoded = indexer.decode_obs(index)
+    print(f'Encoded {len(observations)} observations in {elapsed * 1000:.1f} ms, '
+          f'{len(set(index))} distinct, round trip '
+          f'{"ok" if (indexer.encode_obs(decoded) == index).all() else "FAILED"}')
+
+    start = time.perf_counter()
+    index = indexer.encode_states(states)
+    elapsed = time.perf_counter() - start
+    same = [a._replace(obs = None, characters = tuple(map(tuple, map(sorted, a.characters))))
+            == b for a, b in zip(states, indexer.decode_states(index))]
+    print(f'Encoded {len(states)} states in {elapsed * 1000:.1f} ms, '
+          f'round trip {"ok" if all(same) else "FAILED"}')
@@ -9,15 +9,21 @@ Created on Sun Aug 30 09:07:53 2020
 """
 
 import random
-from resource import Resource, ResourceDie, ResourcePool
+from resource import Resource, ResourceDie, ResourcePool, ENCODED_DICE
 
 # TODO: Add the ability to handle multiple resource types.
 class Location:
     
-    def __init__(self, name, resource_type, pool_size):
+    # Locations are encoded with encoded_dice dice slots, and a slot for
+    # each of character_slots characters
+    def __init__(self, name, resource_type, pool_size,
+                 encoded_dice = ENCODED_DICE, character_slots = 2):
         self.name = name
-        self.rpool = ResourcePool(resource_type, pool_size, True)
+        self.rpool = ResourcePool(resource_type, pool_size, True,
+                                  encoded_dice = encoded_dice)
+        self.character_slots = character_slots
         self.characters = []
+        self.obs = None
         
     def __str__(self):
         loc_string = f'{self.name} ' + str(self.rpool)
@@ -28,6 +34,31 @@ class Location:
     def __repr__(self):
         return self.__str__()    
     
+    # Keeps the location's slots of an observation buffer (a bytearray) up
+    # to date, laid out the same as encode(), starting at the given offset
+    def bind(self, obs, offset):
+        self.rpool.bind(obs, offset)
+        self.obs = obs
+        self.characters_offset = offset + 1 + self.rpool.encoded_dice
+        self._write_characters()
+        
+    def _write_characters(self):
+        if self.obs is None:
+            return
+        i = self.characters_offset
+        cids = [c.cid for c in self.characters]
+        slots = self.character_slots
+        self.obs[i:i + slots] = bytes(cids + [0] * (slots - len(cids)))
+        
+    # Characters arriving at and leaving the location
+    def arrive(self, character):
+        self.characters.append(character)
+        self._write_characters()
+        
+    def leave(self, character):
+        self.characters.remove(character)
+        self._write_characters()
+    
     def add_die(self, die):
         if self.rpool.capacity() <= 0:
             raise Exception('Adding die to location with max resource dice.')
@@ -44,15 +75,12 @@ class Location:
         cs = len(self.characters)
         for i in range(cs):
             obs += self.characters[i].encode()
-        for i in range(2 - cs):
+        for i in range(self.character_slots - cs):
             obs.append(0)
         return obs    
         
     def resource_total(self):
-        total = 0
-        for resource in self.rpool:
-            total += resource.value
-        return total        
+        return self.rpool.total()
         
     # If possible, trade out the lowest valued die less than the proposed die.
     def trade_die(self, die):
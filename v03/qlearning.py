@@ -5,7 +5,13 @@ Created on Sat Feb 13 22:58:43 2021
 @author: phill
 """
 
+import os
+import time
+
 import sixwinters
+import vec_env
+
+from replay import ReplayMemory, PrioritizedReplayMemory, MemmapReplayMemory
 
 import tensorflow as tf
 import numpy as np
@@ -15,26 +21,62 @@ from collections import deque
 import matplotlib.pyplot as plt
 
 def epsilon_greedy_policy(model, state, num_actions, epsilon = 0.0):
-    if np.random.rand() < epsilon or state == None:
+    if np.random.rand() < epsilon or state is None:
         return np.random.randint(num_actions)
     else:
-        state = np.array(state)[np.newaxis]
+        state = state[np.newaxis]
         Q_values = model.predict(state)
         return np.argmax(Q_values[0])
 
-def play_step(replay_buffer, model, num_actions, env, state, epsilon):
-    action = epsilon_greedy_policy(model, state, num_actions, epsilon)
+# Compiles the model into a single call that returns the greedy action for
+# every state in a batch, avoiding the per call overhead of model.predict.
+# The model's weights are read on every call, so it keeps up with training.
+def greedy_action_function(model):
+    
+    @tf.function(input_signature = [tf.TensorSpec((None,) + tuple(model.input_shape[1:]),
+                                                  tf.float32)])
+    def greedy_actions(states):
+        return tf.argmax(model(states, training = False), axis = 1,
+                         output_type = tf.int32)
+    
+    return greedy_actions
+
+# Epsilon greedy actions for a batch of states, e.g. from VecSixWinters.
+# Each state is explored independently, and the model is skipped when every
+# state explores.
+def batched_epsilon_greedy_policy(greedy_actions, states, num_actions, epsilon = 0.0):
+    explore = np.random.rand(len(states)) < epsilon
+    actions = np.random.randint(num_actions, size = len(states))
+    if not explore.all():
+        greedy = greedy_actions(np.asarray(states, dtype = np.float32)).numpy()
+        actions = np.where(explore, actions, greedy)
+    return actions
+
+def play_step(replay_buffer, greedy_actions, num_actions, env, state, epsilon):
+    action = batched_epsilon_greedy_policy(greedy_actions, state[np.newaxis],
+                                           num_actions, epsilon)[0]
     next_state, reward, done, info = env.step(action)
     replay_buffer.append((state, action, reward, next_state, done))
     return next_state, reward, done, info, replay_buffer
 
-def play_game(replay_buffer, model, num_actions, obs, env,
+# Steps every game in a VecSixWinters at once. Finished games are reset by
+# the environment, so their transitions end with the final observation.
+def play_vec_step(replay_buffer, greedy_actions, num_actions, env, states, epsilon):
+    actions = batched_epsilon_greedy_policy(greedy_actions, states, num_actions,
+                                            epsilon)
+    next_states, rewards, dones, info = env.step(actions)
+    ends = next_states.copy()
+    ends[dones] = info['terminal_obs']
+    replay_buffer.add_batch(states, actions, rewards, ends, dones)
+    return next_states, rewards, dones, info, replay_buffer
+
+def play_game(replay_buffer, greedy_actions, num_actions, obs, env,
               episode, max_steps = 200):
     total_rewards = 0
     for step in range(max_steps):
         epsilon = max(1 - (episode / 1000), 0.01)
         obs, reward, done, info, replay_buffer = play_step(replay_buffer, 
-                                                           model, 
+                                                           greedy_actions, 
                                                            num_actions, env, 
                                                            obs, epsilon)
         total_rewards = total_rewards + reward
@@ -43,6 +85,9 @@ def play_game(replay_buffer, model, num_actions, obs, env,
     return replay_buffer, total_rewards
 
 def sample_experiences(replay_buffer, batch_size):    
+    if isinstance(replay_buffer, ReplayMemory):
+        return replay_buffer.sample(batch_size)
+    
     indices = np.random.randint(len(replay_buffer), size = batch_size)
 
     batch = [replay_buffer[index] for index in indices]
@@ -78,25 +123,131 @@ def train(model, num_actions, replay_buffer, optimizer):
     optimizer.apply_gradients(zip(grads, model.trainable_variables))
     return model
     
-# Train a simple Q learning algorithm to play Six Winters
-def qlearn(model_name = 'sw_dqn.h5'):
+# A DQN trainer whose whole update is one compiled call: sampling is done
+# up front, then each of K minibatches computes its targets with the target
+# network, the loss, and takes an optimizer step. The target network is
+# synced to the model every target_period updates, checked between calls.
+#
+# With a PrioritizedReplayMemory, the loss is weighted by the importance
+# sampling weights, and the priorities of every sampled transition are
+# updated with its TD error once the call is done.
+class DQNTrainer:
     
-    env = sixwinters.SixWinters()
+    def __init__(self, model, num_actions, optimizer, discount_factor = 0.95,
+                 batch_size = 32, target_period = 1000):
+        self.model = model
+        self.num_actions = num_actions
+        self.optimizer = optimizer
+        self.discount_factor = discount_factor
+        self.batch_size = batch_size
+        self.target_period = target_period
+        self.updates = 0
+        
+        self.target = tf.keras.models.clone_model(model)
+        self.target.set_weights(model.get_weights())
+        self._synced = 0
+        
+        obs_shape = tuple(model.input_shape[1:])
+        self._update = tf.function(self._update_steps, input_signature = [
+            tf.TensorSpec((None, None) + obs_shape, tf.float32),
+            tf.TensorSpec((None, None), tf.int32),
+            tf.TensorSpec((None, None), tf.float32),
+            tf.TensorSpec((None, None) + obs_shape, tf.float32),
+            tf.TensorSpec((None, None), tf.float32),
+            tf.TensorSpec((None, None), tf.float32)])
+        
+    # One minibatch update, returning the loss and the TD errors
+    def _update_step(self, states, actions, rewards, next_states, dones, weights):
+        next_Q_values = self.target(next_states, training = False)
+        target_Q_values = (rewards + (1 - dones) * self.discount_factor *
+                           tf.reduce_max(next_Q_values, axis = 1))
+        mask = tf.one_hot(actions, self.num_actions)
+        with tf.GradientTape() as tape:
+            Q_values = tf.reduce_sum(self.model(states, training = True) * mask, axis = 1)
+            td_errors = target_Q_values - Q_values
+            loss = tf.reduce_mean(weights * tf.square(td_errors))
+        grads = tape.gradient(loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
+        return loss, td_errors
     
-    input_shape = env.observation_space.shape
-    num_actions = env.action_space.n
+    # Each argument has a leading axis of minibatches. Returns the loss of
+    # the last one and the TD errors of all of them. The first update is
+    # outside the loop, since it may create the optimizer's variables,
+    # which can't happen inside a loop.
+    def _update_steps(self, states, actions, rewards, next_states, dones, weights):
+        num_updates = tf.shape(states)[0]
+        td_errors = tf.TensorArray(tf.float32, size = num_updates)
+        loss, errors = self._update_step(states[0], actions[0], rewards[0],
+                                         next_states[0], dones[0], weights[0])
+        td_errors = td_errors.write(0, errors)
+        for k in tf.range(1, num_updates):
+            loss, errors = self._update_step(states[k], actions[k], rewards[k],
+                                             next_states[k], dones[k], weights[k])
+            td_errors = td_errors.write(k, errors)
+        return loss, td_errors.stack()
     
-    model = tf.keras.models.Sequential([
+    # Runs num_updates minibatch updates sampled from the replay buffer,
+    # returning the loss of the last
+    def train(self, replay_buffer, num_updates = 1):
+        shape = (num_updates, self.batch_size)
+        samples = num_updates * self.batch_size
+        prioritized = isinstance(replay_buffer, PrioritizedReplayMemory)
+        if prioritized:
+            (states, actions, rewards, next_states, dones,
+             weights, rows) = replay_buffer.sample(samples)
+        else:
+            states, actions, rewards, next_states, dones = sample_experiences(
+                replay_buffer, samples)
+            weights = np.ones(samples)
+            
+        loss, td_errors = self._update(
+            states.reshape(shape + states.shape[1:]).astype(np.float32),
+            actions.reshape(shape).astype(np.int32),
+            rewards.reshape(shape).astype(np.float32),
+            next_states.reshape(shape + next_states.shape[1:]).astype(np.float32),
+            dones.reshape(shape).astype(np.float32),
+            weights.reshape(shape).astype(np.float32))
+        
+        if prioritized:
+            replay_buffer.update_priorities(rows, td_errors.numpy().reshape(-1))
+        
+        self.updates += num_updates
+        if self.updates - self._synced >= self.target_period:
+            self.target.set_weights(self.model.get_weights())
+            self._synced = self.updates
+        return float(loss)
+
+def build_model(input_shape, num_actions):
+    return tf.keras.models.Sequential([
         tf.keras.layers.Dense(64, activation = 'elu', input_shape = input_shape),
         tf.keras.layers.Dense(32, activation = 'elu'),
         tf.keras.layers.Dense(16, activation = 'elu'),        
         tf.keras.layers.Dense(num_actions)
         ])
     
+# Train a simple Q learning algorithm to play Six Winters. With a
+# replay_path, experience is kept in that file, and a later run with the
+# same path picks up the experience gathered so far.
+def qlearn(model_name = 'sw_dqn.h5', replay_path = None):
+    
+    # Each observation is stored after the step that follows it, so each
+    # needs its own copy
+    env = sixwinters.SixWinters(copy_obs = True)
+    
+    input_shape = env.observation_space.shape
+    num_actions = env.action_space.n
+    
+    model = build_model(input_shape, num_actions)
+    greedy_actions = greedy_action_function(model)
+    
     # TODO: Tried 1e-3
     optimizer = tf.keras.optimizers.Adam(lr = 1e-4)
     
-    replay_buffer = deque(maxlen = 8000)
+    if replay_path is None:
+        replay_buffer = ReplayMemory(8000, env.observation_space.shape[0])
+    else:
+        replay_buffer = MemmapReplayMemory(replay_path, None if os.path.exists(replay_path)
+                                           else 8000, env.observation_space.shape[0])
     
     num_episodes = 200 # 5000
     
@@ -106,7 +257,7 @@ def qlearn(model_name = 'sw_dqn.h5'):
     # of turns the game lasted, and the total reward
     for episode in range(num_episodes):
         obs = env.reset()
-        replay_buffer, total_rewards = play_game(replay_buffer, model, 
+        replay_buffer, total_rewards = play_game(replay_buffer, greedy_actions, 
                                                  num_actions, obs, env, 
                                                  episode)        
         if episode >= 100:
@@ -117,6 +268,9 @@ def qlearn(model_name = 'sw_dqn.h5'):
             print(episode, ': Exploration Score', total_rewards)
             
         reward_history.append(total_rewards)
+        
+    if replay_path is not None:
+        replay_buffer.close()
     
     window_size = 200
     window = np.ones(window_size) / float(window_size)
@@ -126,5 +280,72 @@ def qlearn(model_name = 'sw_dqn.h5'):
     plt.xlabel('Games Played')
     plt.ylabel('Score')
 
+# Trains a DQN on a batch of games played at once. Every step of the games
+# is followed by update_ratio updates for each game, e.g. 0.25 for one
+# update every four environment steps, run as one compiled call. Progress,
+# including environment steps and updates per second, is printed every
+# report_every seconds. With prioritized = True, transitions are replayed
+# in proportion to their TD errors, with the importance sampling correction
+# growing from beta to full over training.
+def vec_qlearn(num_envs = 16, total_steps = 200000, update_ratio = 0.25,
+               batch_size = 32, warmup = 2000, buffer_size = 50000,
+               epsilon_steps = 100000, target_period = 1000, report_every = 10.0,
+               seed = None, prioritized = False, alpha = 0.6, beta = 0.4):
+    
+    env = vec_env.VecSixWinters(num_envs, seed)
+    input_shape = env.observation_space.shape
+    num_actions = env.action_space.n
+    
+    model = build_model(input_shape, num_actions)
+    greedy_actions = greedy_action_function(model)
+    trainer = DQNTrainer(model, num_actions, tf.keras.optimizers.Adam(1e-4),
+                         batch_size = batch_size, target_period = target_period)
+    
+    if prioritized:
+        replay_buffer = PrioritizedReplayMemory(buffer_size, env.observation_space.shape[0],
+                                                alpha, beta)
+    else:
+        replay_buffer = ReplayMemory(buffer_size, env.observation_space.shape[0])
+    scores = np.zeros(num_envs)
+    finished = deque(maxlen = 1000)
+    owed = 0.0
+    loss = 0.0
+    
+    states = env.reset()
+    start = last_report = time.perf_counter()
+    update_seconds = 0.0
+    
+    for step in range(0, total_steps, num_envs):
+        
+        epsilon = max(1 - step / epsilon_steps, 0.01)
+        if prioritized:
+            replay_buffer.beta = beta + (1 - beta) * step / total_steps
+        states, rewards, dones, info, replay_buffer = play_vec_step(
+            replay_buffer, greedy_actions, num_actions, env, states, epsilon)
+        scores += rewards
+        finished.extend(scores[dones])
+        scores[dones] = 0
+        
+        if len(replay_buffer) >= warmup:
+            owed += update_ratio * num_envs
+            if owed >= 1:
+                updates = int(owed)
+                owed -= updates
+                update_start = time.perf_counter()
+                loss = trainer.train(replay_buffer, updates)
+                update_seconds += time.perf_counter() - update_start
+        
+        now = time.perf_counter()
+        if now - last_report >= report_every:
+            last_report = now
+            elapsed = now - start
+            print(f'{step + num_envs} steps, {(step + num_envs) / elapsed:.0f} steps/sec, '
+                  f'{trainer.updates} updates, '
+                  f'{trainer.updates / max(update_seconds, 1e-9):.0f} updates/sec, '
+                  f'epsilon {epsilon:.2f}, loss {loss:.4f}, mean score '
+                  f'{np.mean(finished) if finished else 0.0:.3f}', flush = True)
+    
+    return model, trainer
+
 if __name__ ==  "__main__":
     qlearn()
\ No newline at end of file
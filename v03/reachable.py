@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Enumerates every state of Six Winters reachable from a set of starting
+boards, breadth first, without holding the states in memory.
+
+Each state is packed into a fixed width record of bytes. The turn timer goes
+up by one every turn, so the states at each depth are distinct from those at
+every other depth, and only need to be deduplicated against each other. The
+frontier is split into chunks which are expanded across a pool of processes,
+each writing its successors to disk as a sorted run, and the runs are then
+merged into the next depth with the duplicates dropped.
+
+The result is a .npy file of records, one row per state and sorted within
+each depth, which can be opened with np.load(mmap_mode = 'r') and searched
+without reading it all into memory. ReachableStates does this.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from resource import Resource
+from rules import DEFAULT_RULES
+from sixwinters import SixWinters, GameState
+from solver import roll_outcomes
+
+# Marks an empty place in the deck or the visible achievements
+EMPTY = 255
+
+# Records are padded to a multiple of this many bytes
+RECORD_ALIGN = 8
+
+# Runs and depths are read and copied this many records at a time, so
+# memory use doesn't grow with the number of states
+BLOCK_RECORDS = 1 << 16
+
+# Each record is the face counts of every resource pool and location, the
+# location of each character, the deck and visible achievements by index,
+# then the timers and whether the game is done. Characters at the same
+# location are kept in order of index, as the order they arrived in has no
+# effect on the game.
+class RecordLayout:
+
+    def __init__(self, config = DEFAULT_RULES):
+        self.config = config
+        self.num_locations = len(config.locations)
+        self.num_characters = len(config.characters)
+        self.num_achievements = len(config.achievements)
+        self.num_visible = config.num_visible_achievements
+
+        self.pools_size = 6 * len(Resource)
+        used = (self.pools_size + 6 * self.num_locations + self.num_characters +
+                self.num_achievements + self.num_visible + 2)
+        self.size = -(-used // RECORD_ALIGN) * RECORD_ALIGN
+        self._padding = [0] * (self.size - used)
+
+    def pack_pools(self, pools):
+        return bytes([count for counts in pools for count in counts])
+
+    # Everything in the record after the resource pools
+    def pack_rest(self, state):
+        values = [count for counts in state.locations for count in counts]
+        positions = [0] * self.num_characters
+        for location, characters in enumerate(state.characters):
+            for c in characters:
+                positions[c] = location
+        values += positions
+        values += state.deck
+        values += [EMPTY] * (self.num_achievements - len(state.deck))
+        values += state.achievements
+        values += [EMPTY] * (self.num_visible - len(state.achievements))
+        values += [state.timers, int(state.done)]
+        return bytes(values + self._padding)
+
+    def pack(self, state):
+        return self.pack_pools(state.pools) + self.pack_rest(state)
+
+    # The GameState for a record, with no observation or random state
+    def unpack(self, record):
+        record = bytes(record)
+
+        offset = self.pools_size
+        pools = tuple([tuple(record[i:i + 6]) for i in range(0, offset, 6)])
+        locations = tuple([tuple(record[i:i + 6])
+                           for i in range(offset, offset + 6 * self.num_locations, 6)])
+        offset += 6 * self.num_locations
+
+        positions = record[offset:offset + self.num_characters]
+        characters = tuple([tuple([c for c, p in enumerate(positions) if p == location])
+                            for location in range(self.num_locations)])
+        offset += self.num_characters
+
+        deck = tuple([i for i in record[offset:offset + self.num_achievements]
+                      if i != EMPTY])
+        offset += self.num_achievements
+        achievements = tuple([i for i in record[offset:offset + self.num_visible]
+                              if i != EMPTY])
+        offset += self.num_visible
+
+        return GameState(pools, locations, characters, deck, achievements,
+                         record[offset], bool(record[offset + 1]), None, None)
+
+# Records as an array of one opaque value each, which sort and compare
+# byte by byte
+def as_keys(records, size):
+    return np.ascontiguousarray(records).view(f'V{size}').reshape(-1)
+
+# The records for num_starts starting boards, rolled from seed
+def start_records(num_starts, seed = 0, config = DEFAULT_RULES):
+    env = SixWinters(config = config)
+    env.seed(seed)
+    layout = RecordLayout(config)
+    records = set()
+    for start in range(num_starts):
+        env.reset()
+        records.add(layout.pack(env.get_state(False)))
+    return sorted(records)
+
+# Each worker builds its environment and refill outcomes once
+_worker_expanders = {}
+
+def _worker_expander(config):
+    expander = _worker_expanders.get(config)
+    if expander is None:
+        outcomes = [[counts for counts, p in roll_outcomes(n)]
+                    for n in range(config.resource_pool_size + 1)]
+        expander = (RecordLayout(config), SixWinters(config = config), outcomes)
+        _worker_expanders[config] = expander
+    return expander
+
+# Writes records to path as a sorted run without duplicates, returning how
+# many were written
+def _write_run(records, size, path):
+    keys = np.unique(as_keys(np.frombuffer(records, np.uint8), size))
+    keys.tofile(path)
+    return len(keys)
+
+# Expands records start to stop of a depth, writing every successor to a
+# sorted run. Finished games aren't expanded. The pools are refilled every
+# way they can be, apart from after the game finishes, when they no longer
+# matter and are left as they are.
+def _expand_chunk(job):
+
+    level_path, num_records, start, stop, run_path, config = job
+    layout, env, outcomes = _worker_expander(config)
+    size = config.resource_pool_size
+    num_actions = config.num_actions
+
+    records = np.memmap(level_path, np.uint8, 'r', shape = (num_records, layout.size))
+    successors = bytearray()
+    generated = 0
+
+    for record in records[start:stop]:
+
+        state = layout.unpack(record)
+        if state.done:
+            continue
+        env.set_state(state)
+        state = env.get_state(False)
+
+        for action in range(num_actions):
+
+            env.set_state(state)
+            env._play(action)
+            after = env.get_state(False)
+            rest = layout.pack_rest(after)
+
+            if after.done:
+                successors += layout.pack_pools(after.pools) + rest
+                generated += 1
+                continue
+
+            missing = [(i, size - sum(counts)) for i, counts in enumerate(after.pools)
+                       if sum(counts) < size]
+            for rolls in itertools.product(*[outcomes[n] for i, n in missing]):
+                pools = list(after.pools)
+                for (i, n), counts in zip(missing, rolls):
+                    pools[i] = [a + b for a, b in zip(pools[i], counts)]
+                successors += layout.pack_pools(pools) + rest
+                generated += 1
+
+    del records
+    return run_path, _write_run(successors, layout.size, run_path), generated
+
+# The records in a run, as keys, a block at a time
+def _read_blocks(path, size, block = BLOCK_RECORDS):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(size * block)
+            if not data:
+                return
+            yield as_keys(np.frombuffer(data, np.uint8), size)
+
+# Merges sorted runs into one file, dropping duplicates, a block of each run
+# at a time, with the blocks sharing block records between them. The rest
+# of a run only holds keys bigger than the last in its block, so every key
+# up to the smallest of those can be merged at once, with a NumPy sort, and
+# none of them will turn up again. Returns the number of records written.
+def _merge_runs(paths, size, out_path, block = BLOCK_RECORDS):
+    run_block = max(block // max(len(paths), 1), 1024)
+    readers = [_read_blocks(path, size, run_block) for path in paths]
+    blocks = [next(reader, None) for reader in readers]
+    written = 0
+    with open(out_path, 'wb') as f:
+        while True:
+            live = [i for i, keys in enumerate(blocks) if keys is not None]
+            if not live:
+                return written
+            bound = np.sort(np.concatenate([blocks[i][-1:] for i in live]))[:1]
+            merged = []
+            for i in live:
+                cut = int(np.searchsorted(blocks[i], bound, side = 'right')[0])
+                merged.append(blocks[i][:cut])
+                blocks[i] = blocks[i][cut:]
+                if not len(blocks[i]):
+                    blocks[i] = next(readers[i], None)
+            keys = np.unique(np.concatenate(merged))
+            keys.tofile(f)
+            written += len(keys)
+
+# Enumerates every state reachable in up to max_depth turns from the given
+# starting records, writing them to directory as states.npy, with an index
+# in states.json of where each depth starts. Each depth is expanded in
+# chunks of chunk_size states. Returns the number of states at each depth.
+def enumerate_states(directory, starts, max_depth = 2, config = DEFAULT_RULES,
+                     processes = None, chunk_size = 1000, log = None):
+
+    layout = RecordLayout(config)
+    size = layout.size
+    work = os.path.join(directory, 'work')
+    os.makedirs(work, exist_ok = True)
+
+    level_paths = [os.path.join(work, 'depth_0.bin')]
+    with open(level_paths[0], 'wb') as f:
+        f.write(b''.join(sorted(set(starts))))
+    counts = [len(set(starts))]
+
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes) as pool:
+
+        for depth in range(1, max_depth + 1):
+
+            start = time.perf_counter()
+            frontier = counts[-1]
+            jobs = [(level_paths[-1], frontier, i, min(i + chunk_size, frontier),
+                     os.path.join(work, f'run_{depth}_{i // chunk_size}.bin'), config)
+                    for i in range(0, frontier, chunk_size)]
+
+            runs = []
+            generated = 0
+            for run_path, written, made in pool.imap_unordered(_expand_chunk, jobs):
+                runs.append(run_path)
+                generated += made
+
+            level_paths.append(os.path.join(work, f'depth_{depth}.bin'))
+            counts.append(_merge_runs(sorted(runs), size, level_paths[-1]))
+            for run_path in runs:
+                os.remove(run_path)
+
+            if log is not None:
+                print(f'depth {depth}: {counts[-1]} states from {generated} '
+                      f'successors of {frontier}, '
+                      f'{time.perf_counter() - start:.1f} sec', file = log, flush = True)
+
+            if counts[-1] == 0:
+                break
+
+    # Join the depths into one array which can be memory mapped
+    states = np.lib.format.open_memmap(os.path.join(directory, 'states.npy'), 'w+',
+                                       np.uint8, (sum(counts), size))
+    offset = 0
+    for path, count in zip(level_paths, counts):
+        if count:
+            level = np.memmap(path, np.uint8, 'r', shape = (count, size))
+            for i in range(0, count, BLOCK_RECORDS):
+                rows = slice(i, min(i + BLOCK_RECORDS, count))
+                states[offset + rows.start:offset + rows.stop] = level[rows]
+            del level
+        offset += count
+    states.flush()
+    del states
+
+    with open(os.path.join(directory, 'states.json'), 'w') as f:
+        json.dump({'config': repr(config), 'record_size': size,
+                   'offsets': np.cumsum([0] + counts).tolist()}, f)
+
+    shutil.rmtree(work)
+    return counts
+
+# Reads the states written by enumerate_states, memory mapped. Records are
+# sorted within each depth, so finding a state is a binary search over the
+# records at its depth.
+class ReachableStates:
+
+    def __init__(self, directory, config = DEFAULT_RULES):
+        with open(os.path.join(directory, 'states.json')) as f:
+            index = json.load(f)
+        if index['config'] != repr(config):
+            raise ValueError(f'{directory} holds states for other rules: {index["config"]}')
+
+        self.layout = RecordLayout(config)
+        self.offsets = index['offsets']
+        self.records = np.load(os.path.join(directory, 'states.npy'), mmap_mode = 'r')
+        self._keys = as_keys(self.records, self.layout.size)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def max_depth(self):
+        return len(self.offsets) - 2
+
+    # The range of indices of the states at a depth
+    def depth(self, depth):
+        return range(self.offsets[depth], self.offsets[depth + 1])
+
+    def state(self, index):
+        return self.layout.unpack(self.records[index])
+
+    # The index of a GameState, or -1 if it wasn't reached
+    def index(self, state):
+        if state.timers > self.max_depth:
+            return -1
+        key = as_keys(np.frombuffer(self.layout.pack(state), np.uint8),
+                      self.layout.size)[0]
+        low, high = self.offsets[state.timers], self.offsets[state.timers + 1]
+        i = low + int(np.searchsorted(self._keys[low:high], key))
+        if i < high and self._keys[i] == key:
+            return i
+        return -1
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Enumerate every reachable '
+                                     'state of Six Winters from some starting boards.')
+    parser.add_argument('--out', default = 'states', help = 'directory to write to')
+    parser.add_argument('--depth', type = int, default = 2)
+    parser.add_argument('--starts', type = int, default = 1,
+                        help = 'number of random starting boards')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--processes', type = int, default = None)
+    parser.add_argument('--chunk-size', type = int, default = 1000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = enumerate_states(args.out, start_records(args.starts, args.seed),
+                              args.depth, processes = args.processes,
+                              chunk_size = args.chunk_size, log = sys.stdout)
+    print(f'{sum(counts)} states in {time.perf_counter() - start:.1f} sec')
+
+    states = ReachableStates(args.out)
+    last = states.depth(states.max_depth)[-1]
+    print(f'{os.path.getsize(os.path.join(args.out, "states.npy")) / 1e6:.1f} MB, '
+          f'last state found at {states.index(states.state(last))} of {len(states)}')
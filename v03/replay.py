@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Replay memory for Q learning, kept in one preallocated NumPy array of
+transitions rather than a deque of tuples. Each transition is a row of a
+structured array: the observation and next observation as uint8, and the
+action, reward and done flag as a byte each, 139 bytes in all with the
+default rules, so millions of transitions fit in memory.
+
+The memory is a ring: once full, new transitions overwrite the oldest.
+Sampling a batch is a single fancy-indexed gather of whole rows.
+
+PrioritizedReplayMemory samples transitions in proportion to their last TD
+error instead, so the rare transitions that complete achievements are
+replayed more often, using a sum tree held in an array.
+
+MemmapReplayMemory keeps the transitions in a file instead, so the memory
+can be bigger than RAM, outlives the process that filled it, and can be
+read by other processes while it is being written.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+from rules import DEFAULT_RULES
+
+def transition_dtype(obs_size):
+    return np.dtype([('state', np.uint8, (obs_size,)),
+                     ('action', np.uint8),
+                     ('reward', np.int8),
+                     ('next_state', np.uint8, (obs_size,)),
+                     ('done', np.uint8)])
+
+class ReplayMemory:
+
+    def __init__(self, capacity, obs_size = DEFAULT_RULES.obs_size):
+        self.capacity = capacity
+        self.transitions = np.zeros(capacity, dtype = transition_dtype(obs_size))
+        self.cursor = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return self.transitions.nbytes
+
+    # Adds one (state, action, reward, next_state, done) transition, the
+    # same as appending to a deque. Returns the row it was written to.
+    def append(self, experience):
+        row = self.cursor
+        self.transitions[row] = experience
+        self.cursor = (self.cursor + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return row
+
+    # Adds a batch of transitions, e.g. one step of a VecSixWinters,
+    # returning the rows they were written to
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        n = len(states)
+        rows = (self.cursor + np.arange(n)) % self.capacity
+        transitions = self.transitions
+        transitions['state'][rows] = states
+        transitions['action'][rows] = actions
+        transitions['reward'][rows] = rewards
+        transitions['next_state'][rows] = next_states
+        transitions['done'][rows] = dones
+        self.cursor = (self.cursor + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        return rows
+
+    # The transitions at the given rows, as arrays of states, actions,
+    # rewards, next states and dones
+    def gather(self, rows):
+        batch = self.transitions[rows]
+        return (batch['state'], batch['action'], batch['reward'],
+                batch['next_state'], batch['done'])
+
+    def sample(self, batch_size):
+        return self.gather(np.random.randint(self.size, size = batch_size))
+
+# A binary tree in an array where each node is the sum of its two
+# children, and the leaves are the priorities of the rows of a replay
+# memory. The root is node 1 and the children of node n are 2n and 2n + 1,
+# so the leaves start at the first power of two at least the capacity.
+# Updating and finding leaves take O(log n) per row, done a level at a time
+# for a whole batch of rows.
+class SumTree:
+
+    def __init__(self, capacity):
+        self.leaves = 1
+        self.depth = 0
+        while self.leaves < capacity:
+            self.leaves *= 2
+            self.depth += 1
+        self.tree = np.zeros(2 * self.leaves)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, rows):
+        return self.tree[self.leaves + np.asarray(rows)]
+
+    # Sets the priorities of rows, then recomputes their ancestors from
+    # their children, so repeated rows and rounding errors don't build up
+    def update(self, rows, priorities):
+        tree = self.tree
+        nodes = self.leaves + np.asarray(rows)
+        tree[nodes] = priorities
+        for level in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            tree[nodes] = tree[2 * nodes] + tree[2 * nodes + 1]
+
+    # The row for each value from 0 up to the total, walking down from the
+    # root to the leaf whose span of the running sum holds it
+    def find(self, values):
+        tree = self.tree
+        values = np.array(values, dtype = np.float64)
+        nodes = np.ones(len(values), dtype = np.int64)
+        for level in range(self.depth):
+            left = 2 * nodes
+            right = values >= tree[left]
+            values -= np.where(right, tree[left], 0.0)
+            nodes = left + right
+        return nodes - self.leaves
+
+# Samples each transition with probability proportional to its priority to
+# the power alpha, where its priority is its last TD error plus a little,
+# so every transition has some chance. New transitions start at the highest
+# priority seen, so they are replayed at least once. Samples come with
+# importance sampling weights to correct for the bias, with beta going from
+# partly to fully corrected over training.
+class PrioritizedReplayMemory(ReplayMemory):
+
+    def __init__(self, capacity, obs_size = DEFAULT_RULES.obs_size, alpha = 0.6,
+                 beta = 0.4, min_priority = 1e-3):
+        super().__init__(capacity, obs_size)
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.min_priority = min_priority
+        self.max_priority = 1.0
+
+    def append(self, experience):
+        row = super().append(experience)
+        self.tree.update([row], self.max_priority ** self.alpha)
+        return row
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        rows = super().add_batch(states, actions, rewards, next_states, dones)
+        self.tree.update(rows, self.max_priority ** self.alpha)
+        return rows
+
+    # A batch drawn in proportion to priority, one from each of batch_size
+    # equal slices of the total. Returns the transitions as from
+    # ReplayMemory.sample, then their importance sampling weights, scaled so
+    # the largest in the batch is 1, and their rows to update later.
+    def sample(self, batch_size):
+        tree = self.tree
+        bounds = (np.arange(batch_size) + np.random.rand(batch_size)) / batch_size
+        rows = np.minimum(tree.find(bounds * tree.total), self.size - 1)
+        probabilities = tree.get(rows) / tree.total
+        weights = (self.size * probabilities) ** -self.beta
+        weights /= weights.max()
+        return self.gather(rows) + (weights, rows)
+
+    def update_priorities(self, rows, td_errors):
+        priorities = np.abs(td_errors) + self.min_priority
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(rows, priorities ** self.alpha)
+
+# Memory mapped replay files start with a header of this many bytes: the
+# magic, then int64 fields, then the transition dtype as JSON
+REPLAY_MAGIC = b'SWREPLAY'
+REPLAY_FORMAT = 1
+HEADER_BYTES = 4096
+FORMAT, CAPACITY, CURSOR, SIZE, OBS_SIZE, SCHEMA_BYTES = range(6)
+SCHEMA_OFFSET = len(REPLAY_MAGIC) + 6 * 8
+
+# A ReplayMemory in a file. Opening a file which exists resumes it, with
+# its capacity and contents, as long as it holds transitions of the same
+# layout. The file is created sparse, so its size on disk grows as it
+# fills. The cursor and size live in the header, and are updated after the
+# rows they cover are written, so readers opened with readonly = True can
+# sample from it while another process writes. Once the memory is full, a
+# reader may occasionally get a row as it's being overwritten.
+class MemmapReplayMemory(ReplayMemory):
+
+    def __init__(self, path, capacity = None, obs_size = DEFAULT_RULES.obs_size,
+                 readonly = False):
+        self.path = path
+        self.readonly = readonly
+        dtype = transition_dtype(obs_size)
+        schema = json.dumps(dtype.descr).encode()
+
+        if not os.path.exists(path):
+            if readonly or capacity is None:
+                raise FileNotFoundError(f'No replay memory at {path}')
+            fields = np.zeros(6, dtype = np.int64)
+            fields[[FORMAT, CAPACITY, OBS_SIZE, SCHEMA_BYTES]] = (REPLAY_FORMAT, capacity,
+                                                                 obs_size, len(schema))
+            with open(path, 'wb') as f:
+                f.write(REPLAY_MAGIC + fields.tobytes() + schema)
+                f.truncate(HEADER_BYTES + capacity * dtype.itemsize)
+
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_BYTES)
+        fields = np.frombuffer(header, np.int64, 6, len(REPLAY_MAGIC))
+        if header[:len(REPLAY_MAGIC)] != REPLAY_MAGIC or fields[FORMAT] != REPLAY_FORMAT:
+            raise ValueError(f'{path} is not a replay memory')
+        if header[SCHEMA_OFFSET:SCHEMA_OFFSET + fields[SCHEMA_BYTES]] != schema:
+            raise ValueError(f'{path} holds transitions with a different layout')
+        if capacity is not None and capacity != fields[CAPACITY]:
+            raise ValueError(f'{path} has a capacity of {fields[CAPACITY]}, not {capacity}')
+
+        mode = 'r' if readonly else 'r+'
+        self.capacity = int(fields[CAPACITY])
+        self._fields = np.memmap(path, np.int64, mode, len(REPLAY_MAGIC), (6,))
+        self.transitions = np.memmap(path, dtype, mode, HEADER_BYTES, (self.capacity,))
+
+    @property
+    def cursor(self):
+        return int(self._fields[CURSOR])
+
+    @cursor.setter
+    def cursor(self, cursor):
+        self._fields[CURSOR] = cursor
+
+    @property
+    def size(self):
+        return int(self._fields[SIZE])
+
+    @size.setter
+    def size(self, size):
+        self._fields[SIZE] = size
+
+    def flush(self):
+        if not self.readonly:
+            self.transitions.flush()
+            self._fields.flush()
+
+    def close(self):
+        self.flush()
+        del self._fields, self.transitions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Seconds per call of fn, averaged over number calls
+def _time(fn, number = 200):
+    start = time.perf_counter()
+    for i in range(number):
+        fn()
+    return (time.perf_counter() - start) / number
+
+if __name__ == "__main__":
+
+    from collections import deque
+    from vec_env import VecSixWinters
+
+    # The old way, for comparison
+    def sample_deque(replay_buffer, batch_size):
+        indices = np.random.randint(len(replay_buffer), size = batch_size)
+        batch = [replay_buffer[index] for index in indices]
+        return [np.array([experience[field] for experience in batch])
+                for field in range(5)]
+
+    capacity = 100000
+    env = VecSixWinters(256, seed = 0)
+    memory = ReplayMemory(capacity)
+    replay_buffer = deque(maxlen = capacity)
+    print(f'{memory.transitions.itemsize} bytes per transition, '
+          f'{memory.nbytes / 1e6:.1f} MB for {capacity}')
+
+    states = env.reset()
+    start = time.perf_counter()
+    for step in range(capacity // 256):
+        actions = env.np_random.integers(env.action_space.n, size = 256)
+        next_states, rewards, dones, info = env.step(actions)
+        memory.add_batch(states, actions, rewards, next_states, dones)
+        for experience in zip(states.tolist(), actions, rewards,
+                              next_states.tolist(), dones):
+            replay_buffer.append(experience)
+        states = next_states
+    print(f'Filled in {time.perf_counter() - start:.1f} sec')
+
+    for batch_size in (32, 1024):
+        old = _time(lambda: sample_deque(replay_buffer, batch_size))
+        new = _time(lambda: memory.sample(batch_size))
+        print(f'Batch of {batch_size}: deque {old * 1e6:.0f} us, '
+              f'ReplayMemory {new * 1e6:.0f} us')
+
+    # Uniform against prioritized sampling at a million transitions, filled
+    # with random transitions and priorities
+    capacity = 1000000
+    uniform = ReplayMemory(capacity)
+    prioritized = PrioritizedReplayMemory(capacity)
+    obs = np.random.randint(0, 7, size = (10000, DEFAULT_RULES.obs_size))
+    start = time.perf_counter()
+    for i in range(0, capacity, len(obs)):
+        for memory in (uniform, prioritized):
+            memory.add_batch(obs, obs[:, 0], obs[:, 1] == 6, obs, obs[:, 2] == 6)
+    prioritized.update_priorities(np.arange(capacity),
+                                  np.random.exponential(size = capacity))
+    print(f'Filled {capacity} in {time.perf_counter() - start:.1f} sec')
+
+    for batch_size in (32, 1024):
+        rows = prioritized.sample(batch_size)[-1]
+        errors = np.random.exponential(size = batch_size)
+        old = _time(lambda: uniform.sample(batch_size))
+        new = _time(lambda: prioritized.sample(batch_size))
+        update = _time(lambda: prioritized.update_priorities(rows, errors))
+        print(f'Batch of {batch_size}: uniform {old * 1e6:.0f} us, prioritized '
+              f'{new * 1e6:.0f} us, priority update {update * 1e6:.0f} us')
+
+    # The same memory in a file, written then reopened, and read by a
+    # second, read only, view of it
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'replay.bin')
+    with MemmapReplayMemory(path, capacity) as on_disk:
+        start = time.perf_counter()
+        for i in range(0, capacity // 2, len(obs)):
+            on_disk.add_batch(obs, obs[:, 0], obs[:, 1] == 6, obs, obs[:, 2] == 6)
+        print(f'Wrote {len(on_disk)} to {path} in {time.perf_counter() - start:.1f} sec')
+    with MemmapReplayMemory(path) as on_disk, \
+         MemmapReplayMemory(path, readonly = True) as reader:
+        on_disk.add_batch(obs, obs[:, 0], obs[:, 1] == 6, obs, obs[:, 2] == 6)
+        print(f'Reopened with {len(on_disk)}, reader sees {len(reader)}')
+        for batch_size in (32, 1024):
+            new = _time(lambda: reader.sample(batch_size))
+            print(f'Batch of {batch_size}: memory mapped {new * 1e6:.0f} us')
+    os.remove(path)
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-Tracks the community resource pools as sorted lists of resource dice,
+Tracks the community resource pools as counts of each resource die face,
 along with utilities for handling resource types and resource dice.
 
 Created on Sat Aug 29 11:02:54 2020
@@ -8,10 +8,13 @@ Created on Sat Aug 29 11:02:54 2020
 @author: phill
 """
 
-import bisect
 import random
 from enum import Enum
 
+import numpy as np
+
+from zobrist import DIE_KEYS, DIE_PREFIX, NO_KEYS, NO_PREFIX
+
 class Resource(Enum):
     MANA = 0
     TIMBER = 1
@@ -19,17 +22,117 @@ class Resource(Enum):
     LUXURY = 3
     FOOD = 4
 
+# Random numbers are drawn from range(ROLL_RANGE). It's divisible by 1-6, so
+# a draw modulo 6 is a fair die, and small enough that every draw is one of
+# Python's cached small ints, so handing them out allocates nothing.
+ROLL_RANGE = 60
+
+# Hands out random numbers for the game engine from a block of draws made in
+# bulk from a NumPy Generator, drawing a new block when it runs out. Giving
+# each environment its own roller makes seeding reproducible, and
+# get_state() is cheap since blocks are never modified once drawn.
+class DiceRoller:
+    
+    def __init__(self, rng = None, block_size = 4096):
+        self.block_size = block_size
+        self.reseed(rng)
+        
+    # Switch to drawing from a new Generator, or a seed for one
+    def reseed(self, rng = None):
+        if not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng)
+        self.rng = rng
+        self._draw_block()
+        
+    def _draw_block(self):
+        self.block = self.rng.integers(0, ROLL_RANGE, self.block_size,
+                                       dtype = np.uint8).tolist()
+        self.cursor = 0
+        self._rng_state = self.rng.bit_generator.state
+        
+    def _draw(self):
+        if self.cursor >= self.block_size:
+            self._draw_block()
+        draw = self.block[self.cursor]
+        self.cursor += 1
+        return draw
+        
+    # A random die face from 0-5
+    def face(self):
+        if self.cursor >= self.block_size:
+            self._draw_block()
+        draw = self.block[self.cursor]
+        self.cursor += 1
+        return draw % 6
+    
+    # A random integer from range(n)
+    def randrange(self, n):
+        if ROLL_RANGE % n == 0:
+            return self._draw() % n
+        
+        # Otherwise combine draws into a larger range, throwing away the
+        # top of the range that would make some values more likely
+        while True:
+            span = 1
+            draw = 0
+            while span < n:
+                draw = draw * ROLL_RANGE + self._draw()
+                span *= ROLL_RANGE
+            if draw < span - span % n:
+                return draw % n
+    
+    def get_state(self):
+        return (self.block, self.cursor, self._rng_state)
+    
+    def set_state(self, state):
+        block, self.cursor, rng_state = state
+        if block is not self.block:
+            self.block = block
+            self._rng_state = rng_state
+            self.rng.bit_generator.state = rng_state
+    
+# Used by dice and pools that aren't given a roller of their own
+default_roller = DiceRoller()
+        
+# Dice are immutable flyweights. There is exactly one die for each resource
+# type and value, shared by the whole process, so making or rolling a die
+# picks one of the interned dice rather than allocating a new object.
 class ResourceDie:
     
-    def __init__(self, resource_type, resource_value = None):
-        self.resource_type = resource_type
-        if resource_value:
-            self.value = resource_value
-        else:
-            self.value = random.randint(1, 6)
+    __slots__ = ('resource_type', 'value')
+    
+    def __new__(cls, resource_type, resource_value = None):
+        if not resource_value:
+            return roll_die(resource_type)
+        if not 1 <= resource_value <= 6:
+            raise ValueError(f'Resource die value {resource_value} is not 1-6.')
+        return DICE[resource_type.value][resource_value - 1]
+    
+    @classmethod
+    def _intern(cls, resource_type, resource_value):
+        die = object.__new__(cls)
+        object.__setattr__(die, 'resource_type', resource_type)
+        object.__setattr__(die, 'value', resource_value)
+        return die
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('Resource dice are immutable.')
+        
+    # Dice can't change value, so rolling returns a new die of the same type
+    def roll(self, roller = default_roller):
+        return roll_die(self.resource_type, roller)
+    
+    # Copies and unpickled dice are the interned die
+    def __reduce__(self):
+        return (ResourceDie, (self.resource_type, self.value))
+    
+    def __copy__(self):
+        return self
     
-    def roll(self):
-        self.value = random.randint(1, 6)
+    def __deepcopy__(self, memo):
+        return self
+        
+    __hash__ = object.__hash__
         
     def __str__(self):
         return f"{self.resource_type} {self.value}"
@@ -62,11 +165,21 @@ class ResourceDie:
     def __ge__(self, other):
         return (self.value >= other.value)
     
+# The interned dice, indexed by [resource_type.value][value - 1]
+DICE = tuple(tuple(ResourceDie._intern(resource_type, value)
+                   for value in range(1, 7))
+             for resource_type in Resource)
+
+def roll_die(resource_type, roller = default_roller):
+    return DICE[resource_type.value][roller.face()]
+    
 # A resource die aware of the location it comes from - useful for sorting
 # algorithms where combinations of dice summing to a total are found, and
 # removed from associated location or resource pools
 class LocationResourceDie():
     
+    __slots__ = ('die', 'location')
+    
     def __init__(self, die, location):
         self.die = die
         self.location = location
@@ -95,63 +208,196 @@ class LocationResourceDie():
     def __ge__(self, other):
         return self.die.__ge__(other)       
     
+# Pools also track which faces are present as a 6 bit mask, so the
+# highest face at or under a value (0-6), and the lowest face, can be looked
+# up directly. Faces are numbered 0-5 here, with -1 meaning there is none.
+HIGHEST_FACE_UNDER = [[max([f for f in range(value) if mask >> f & 1],
+                           default = -1)
+                       for value in range(7)]
+                      for mask in range(64)]
+
+LOWEST_FACE = [min([f for f in range(6) if mask >> f & 1], default = -1)
+               for mask in range(64)]
+
+# The face mask, number of dice and total for a tuple of face counts. There
+# are only a few hundred pools that come up, so these are cached.
+_COUNT_SUMMARIES = {}
+
+def summarize_counts(counts):
+    summary = _COUNT_SUMMARIES.get(counts)
+    if summary is None:
+        faces_present = 0
+        for face, count in enumerate(counts):
+            if count:
+                faces_present |= 1 << face
+        summary = (faces_present, sum(counts),
+                   sum(count * (face + 1) for face, count in enumerate(counts)))
+        _COUNT_SUMMARIES[counts] = summary
+    return summary
+
+# Pools and locations are encoded with room for five dice by default
+ENCODED_DICE = 5
+
+# The most dice slots a pool or location can be encoded with
+MAX_ENCODED_DICE = 16
+
+# The run of encoded dice for each face and count, e.g. [3, 3] for two 3s
+DICE_RUNS = [[bytes([value]) * count for count in range(MAX_ENCODED_DICE + 1)]
+             for value in range(7)]
+    
+# Dice in a pool are only told apart by their value, so a pool is stored as
+# a count of each of the six faces, along with a running size and total.
+# Dice handed back by queries are the interned dice for the pool's type.
 class ResourcePool:
     
-    def __init__(self, resource_type, pool_size, start_empty = False):
+    def __init__(self, resource_type, pool_size, start_empty = False,
+                 roller = default_roller, encoded_dice = ENCODED_DICE):
         self.resource_type = resource_type
+        self.roller = roller
         self.pool_size = pool_size
-        self.dice = []
+        self.encoded_dice = encoded_dice
+        self.counts = [0] * 6
+        self.faces_present = 0
+        self.size = 0
+        self._total = 0
+        self._faces = DICE[resource_type.value]
         
-        if start_empty:
-            return
+        # Zobrist hash of the dice, using the keys of the pool's slot in the
+        # game once set by hash_slot
+        self.hash = 0
+        self._hash_keys = NO_KEYS
+        self._hash_prefix = NO_PREFIX
         
-        for i in range(pool_size):
-            bisect.insort_left(self.dice, ResourceDie(resource_type))
+        # Set by bind, the observation buffer the pool keeps up to date
+        self.obs = None
+        self.obs_offset = 0
+        
+        if not start_empty:
+            self.refill()
         
     def __iter__(self):
-        return self.dice.__iter__()
+        for die, count in zip(self._faces, self.counts):
+            for i in range(count):
+                yield die
             
     def __str__(self):
         res_string = f'{self.resource_type.name}({self.pool_size}): '
-        for r in self.dice:
+        for r in self:
             res_string += str(r.value) + ' '
         return res_string
     
     def __repr__(self):
         return self.__str__()   
     
+    # The dice in the pool, sorted from lowest to highest
+    @property
+    def dice(self):
+        return list(self)
+    
     def total(self):
-        total = 0
-        for die in self.dice:
-            total = total + die.value
-        return total
+        return self._total
     
     def refill(self):
-        while len(self.dice) < self.pool_size:
-            bisect.insort_left(self.dice, ResourceDie(self.resource_type))
+        while self.size < self.pool_size:
+            self._put(self.roller.face())
+        if self.obs is not None:
+            self._write_obs()
+            
+    # Empties the pool, and rolls a full set of new dice
+    def reroll(self):
+        counts = [0] * 6
+        for i in range(self.pool_size):
+            counts[self.roller.face()] += 1
+        self.set_counts(tuple(counts))
+        
+    def clear(self):
+        if self.size:
+            self.set_counts((0, 0, 0, 0, 0, 0))
+        
+    # Replaces the dice in the pool with the given count of each face
+    def set_counts(self, counts):
+        self.restore(counts)
+        if self.obs is not None:
+            self._write_obs()
+            
+    # Like set_counts, but leaves the observation buffer alone, for callers
+    # that restore the whole buffer themselves
+    def restore(self, counts):
+        self.counts[:] = counts
+        self.faces_present, self.size, self._total = summarize_counts(counts)
+        prefix = self._hash_prefix
+        self.hash = (prefix[0][counts[0]] ^ prefix[1][counts[1]] ^
+                     prefix[2][counts[2]] ^ prefix[3][counts[3]] ^
+                     prefix[4][counts[4]] ^ prefix[5][counts[5]])
+            
+    # Hash the pool with the keys for a slot, so each pool and location in
+    # a game hashes differently
+    def hash_slot(self, slot):
+        self._hash_keys = DIE_KEYS[slot]
+        self._hash_prefix = DIE_PREFIX[slot]
+        self.restore(tuple(self.counts))
             
     def capacity(self):
-        return self.pool_size - len(self.dice)            
+        return self.pool_size - self.size
         
     # What is the highest valued die less than or equal to the given value?
     def highest_die_under(self, lvalue):
-        i = bisect.bisect(self.dice, ResourceDie(self.resource_type, lvalue))
-        if i > 0:
-            return self.dice[i - 1]
+        face = HIGHEST_FACE_UNDER[self.faces_present][max(0, min(lvalue, 6))]
+        if face >= 0:
+            return self._faces[face]
         else:
             return None
         
     def lowest_die(self):
-        if len(self.dice) > 0:
-            return self.dice[0]
+        face = LOWEST_FACE[self.faces_present]
+        if face >= 0:
+            return self._faces[face]
         else:
             return None
         
-    def add(self, die):            
-        bisect.insort_left(self.dice, die)
+    def _put(self, face):
+        self.hash ^= self._hash_keys[face][self.counts[face]]
+        self.counts[face] += 1
+        self.faces_present |= 1 << face
+        self.size += 1
+        self._total += face + 1
+        
+    def add(self, die):
+        self._put(die.value - 1)
+        if self.obs is not None:
+            self._write_obs()
         
     def remove(self, die):
-        self.dice.remove(die)
+        face = die.value - 1
+        if not self.counts[face]:
+            raise ValueError(f'{die} is not in the {self.resource_type.name} pool.')
+        self.counts[face] -= 1
+        self.hash ^= self._hash_keys[face][self.counts[face]]
+        if not self.counts[face]:
+            self.faces_present &= ~(1 << face)
+        self.size -= 1
+        self._total -= die.value
+        if self.obs is not None:
+            self._write_obs()
+        
+    # Keeps the pool's slots of an observation buffer (a bytearray) up to
+    # date, laid out the same as encode(), starting at the given offset
+    def bind(self, obs, offset):
+        self.obs = obs
+        self.obs_offset = offset
+        obs[offset] = self.resource_type.value
+        self._write_obs()
+        
+    # Rewrites the dice slots, which are sorted so any change can shift them
+    def _write_obs(self):
+        obs = self.obs
+        i = self.obs_offset + 1
+        for value, count in enumerate(self.counts, 1):
+            if count:
+                obs[i:i + count] = DICE_RUNS[value][count]
+                i += count
+        end = self.obs_offset + 1 + self.encoded_dice
+        obs[i:end] = DICE_RUNS[0][end - i]
         
     # Returns an encoding for the resource pool that can be returned
     # for Open AI Gym. The encoding is an integer for the resource
@@ -159,11 +405,10 @@ class ResourcePool:
     def encode(self):
         obs = [self.resource_type.value]
         
-        for nd in self.dice:
-            obs.append(nd.value)
+        for value, count in enumerate(self.counts, 1):
+            obs += [value] * count
                     
-        for i in range(5 - len(self.dice)):
-            obs.append(0)
+        obs += [0] * (self.encoded_dice - self.size)
         
         return obs        
 
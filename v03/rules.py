@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+The rules of a game of Six Winters: how long it lasts, the size of the
+pools and locations, the board, the characters and the achievements. A
+SixWinters environment builds its board, observation layout and spaces from
+a RulesConfig, so many variants of the rules can be played in one process.
+"""
+
+from collections import namedtuple
+
+from resource import Resource
+
+LocationRule = namedtuple('LocationRule', ['name', 'resource_type'])
+
+CharacterRule = namedtuple('CharacterRule', ['name', 'cid', 'command'])
+
+# Achievements are all for getting a total of one type of resource
+AchievementRule = namedtuple('AchievementRule', ['resource_type', 'total'])
+
+# A simple upper bound on the length of the game
+MAX_TIMERS = 10
+
+# The number of dice in each resource pool at the start of each turn
+RESOURCE_POOL_SIZE = 5
+
+# The max number of resource dice which may be placed on each location
+LOCATION_POOL_SIZE = 3
+
+LOCATIONS = (LocationRule('Ore Town', Resource.ORE),
+             LocationRule('Timberville', Resource.TIMBER),
+             LocationRule('Flavortown', Resource.FOOD),
+             LocationRule('Manasberg', Resource.MANA))
+
+CHARACTERS = (CharacterRule('Keel', 1, 3),
+              CharacterRule('Thea', 2, 3))
+
+# In the order they are put into the deck, before shuffling
+ACHIEVEMENTS = (AchievementRule(Resource.TIMBER, 7),
+                AchievementRule(Resource.MANA, 7),
+                AchievementRule(Resource.ORE, 7),
+                AchievementRule(Resource.FOOD, 7))
+
+NUM_VISIBLE_ACHIEVEMENTS = 2
+
+# Rules are immutable and hashable, so they can key caches and results.
+# The observation layout follows from the rules: a pool for each Resource,
+# then the visible achievements, then each location, with pools and
+# locations encoding as many dice as the larger of the two can hold.
+class RulesConfig(namedtuple('RulesConfig',
+                             ['max_timers', 'resource_pool_size',
+                              'location_pool_size', 'locations', 'characters',
+                              'achievements', 'num_visible_achievements'],
+                             defaults = (MAX_TIMERS, RESOURCE_POOL_SIZE,
+                                         LOCATION_POOL_SIZE, LOCATIONS,
+                                         CHARACTERS, ACHIEVEMENTS,
+                                         NUM_VISIBLE_ACHIEVEMENTS))):
+
+    __slots__ = ()
+
+    @property
+    def dice_slots(self):
+        return max(self.resource_pool_size, self.location_pool_size)
+
+    @property
+    def num_actions(self):
+        return len(self.characters) * len(self.locations)
+
+    @property
+    def pool_obs_size(self):
+        return 1 + self.dice_slots
+
+    @property
+    def location_obs_size(self):
+        return 1 + self.dice_slots + len(self.characters)
+
+    @property
+    def achievements_offset(self):
+        return len(Resource) * self.pool_obs_size
+
+    @property
+    def locations_offset(self):
+        return self.achievements_offset + 3 * self.num_visible_achievements
+
+    @property
+    def obs_size(self):
+        return self.locations_offset + len(self.locations) * self.location_obs_size
+
+DEFAULT_RULES = RulesConfig()
+
+if __name__ == "__main__":
+
+    print(DEFAULT_RULES)
+    print('Observation size', DEFAULT_RULES.obs_size)
+    print(DEFAULT_RULES._replace(max_timers = 12, location_pool_size = 4).obs_size)
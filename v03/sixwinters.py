@@ -7,31 +7,42 @@ Created on Sun Sep  6 10:52:26 2020
 
 import gym
 from gym import spaces
-from gym.utils import seeding
 
-import random
+from collections import namedtuple
+
+import numpy as np
 
 from deck import Deck
 from character import Skill, Character
 from location import Location
-from resource import Resource, ResourcePool
+from resource import Resource, ResourcePool, DiceRoller, default_roller
 from achievement import AchievementType, SumResourceAchievement
+from rules import DEFAULT_RULES
+from symmetry import identical_characters, real_action, canonical_obs
+from zobrist import CHARACTER_KEYS, VISIBLE_KEYS, DECK_KEYS, DONE_KEY, timer_key
 
-# A simple upper bound on the length of the game
-MAX_TIMERS = 10
-
-# The number of dice in each resource pool at the start of each turn
-RESOURCE_POOL_SIZE = 5
-
-# The max number of resource dice which may be placed on each location
-LOCATION_POOL_SIZE = 3
+# A compact snapshot of a game, from SixWinters.get_state(). Pools and
+# locations are tuples of face counts, characters lists the character
+# indices at each location in the order they arrived, and the deck and
+# achievements are indices into SixWinters.achievements. obs is a copy of
+# the observation buffer and rng the random state, either of which may be
+# None.
+GameState = namedtuple('GameState', ['pools', 'locations', 'characters',
+                                     'deck', 'achievements', 'timers', 'done',
+                                     'obs', 'rng'])
+    
+# Independent seeds for n workers, from a single master seed. Seeding
+# each worker's SixWinters with one of these gives parallel runs that are
+# reproducible and don't share random streams.
+def spawn_seeds(master_seed, n):
+    return np.random.SeedSequence(master_seed).spawn(n)
     
 # Randomly shuffles a character from one location to another
-def randomly_move_characters(character, locations):
-    character.location.characters.remove(character)
-    new_location = random.randint(0, len(locations) - 1)
+def randomly_move_characters(character, locations, roller = default_roller):
+    character.location.leave(character)
+    new_location = roller.randrange(len(locations))
     character.location = locations[new_location]
-    character.location.characters.append(character)
+    character.location.arrive(character)
     
 # Remove dice from the listed locations
 def pay_for_achievement(loc_dice):
@@ -78,69 +89,205 @@ class SixWinters(gym.Env):
     # The most important parts of the environment are the action_space
     # and the observation_space. Essentially, what the AI can see
     # and what the AI can do
-    def __init__(self):
+    #
+    # Observations are a read-only view of a buffer that the environment
+    # keeps up to date as the game changes. Pass copy_obs = True to get a
+    # new array for each observation instead, e.g. to store in a replay
+    # buffer.
+    #
+    # With reset_bank_size > 0, that many starting boards are rolled up
+    # front, and reset() picks one of them instead of rolling a new board.
+    #
+    # All of the dice rolls and shuffles come from the environment's own
+    # roller, seeded by seed (an int or a np.random.SeedSequence).
+    #
+    # With canonical = True, observations fold together games that are the
+    # same up to swapping characters with the same skills, or the order of
+    # the visible achievements (see symmetry.py). Actions then refer to the
+    # characters in the order they appear in the observation.
+    #
+    # state_hash is a 64 bit Zobrist hash of the game, updated as dice,
+    # characters and achievements change. Keys are fixed, so the same game
+    # hashes the same in every process. It identifies the game as the player
+    # sees it, not the full state: which characters are at each location but
+    # not the order they arrived, which has no effect on play, and the cards
+    # left in the deck but not their order, which decides the next draw but
+    # can't be seen.
+    #
+    # The board, game length and achievements come from config, a
+    # RulesConfig (see rules.py), as do the spaces and observation layout.
+    def __init__(self, copy_obs = False, reset_bank_size = 0, seed = None,
+                 canonical = False, config = DEFAULT_RULES):
+        
+        self.config = config
         
         # Each character may move to a different location
-        # The first four options move character A, and the second
-        # four move character B
-        self.action_space = spaces.Discrete(8)
+        # The first options move the first character to each location,
+        # the next move the second character, and so on
+        self.action_space = spaces.Discrete(config.num_actions)
         
         # The board state is represented as a list of discrete values
         obs = []
-        for i in range(68):
+        for i in range(config.obs_size):
             obs.append(6)
             
         self.observation_space = spaces.MultiDiscrete(obs)        
-        self.seed()
+        
+        # Pools, achievements and locations each write their own slots
+        self.copy_obs = copy_obs
+        self._obs_buffer = bytearray(len(obs))
+        self.obs = np.frombuffer(self._obs_buffer, dtype = np.uint8)
+        self._obs_view = self.obs.view()
+        self._obs_view.flags.writeable = False
+        
+        self.canonical = canonical
+        if canonical:
+            self._canonical_obs = np.zeros(len(obs), dtype = np.uint8)
+            self._canonical_view = self._canonical_obs.view()
+            self._canonical_view.flags.writeable = False
+        
+        self.roller = DiceRoller()
+        self.seed(seed)
+        
+        # The board is built once, and reset() puts the same objects back
+        # into a starting position
+        self._build()
+        
+        self._reset_bank = [self._roll_start() for i in range(reset_bank_size)]
         
     # Bookkeeping to move a character from one location to another
     def _move_character(self, character, location):
         
         # Remove current character from list of characters at location
-        character.location.characters.remove(character)
+        keys = CHARACTER_KEYS[self._character_index[character]]
+        self._hash ^= (keys[self._location_index[character.location]] ^
+                       keys[self._location_index[location]])
+        character.location.leave(character)
         
         # Update character reference and location reference
         character.location = location
-        location.characters.append(character)
+        location.arrive(character)
         
-    # Returns game state, called at the end of each step
-    def _get_obs(self):
+    # Points each pool and location at its slots of the observation buffer
+    def _bind_obs(self):
         
-        obs = []
+        config = self.config
+        offset = 0
         
         for rp in self.resource_pools:
-            obs += rp.encode()        
+            rp.bind(self._obs_buffer, offset)
+            offset += config.pool_obs_size
+            
+        self._achievements_offset = offset
+        self._write_achievements()
+        offset += 3 * config.num_visible_achievements
+        
+        for loc in self.locations:
+            loc.bind(self._obs_buffer, offset)
+            offset += config.location_obs_size
             
+    # Called whenever the visible achievements change
+    def _write_achievements(self):
+        
+        obs = []
+        
         for achievement in self.current_achievements:
             obs += achievement.encode()
         
         # 0 pad out missing achievements
-        for i in range((2 - len(self.current_achievements)) * 3):
-            obs += [0]            
+        visible = self.config.num_visible_achievements
+        for i in range((visible - len(self.current_achievements)) * 3):
+            obs += [0]
+            
+        i = self._achievements_offset
+        self._obs_buffer[i:i + 3 * visible] = bytes(obs)
         
-        for loc in self.locations:
-            obs += loc.encode()
+    # Zobrist hash of the current state
+    @property
+    def state_hash(self):
+        h = self._hash
+        for pool in self._hashed_pools:
+            h ^= pool.hash
+        return h
         
-        return obs
+    # Recomputes the hash of everything but the dice, which the pools hash
+    # themselves
+    def _rehash(self):
         
+        h = 0
+        for i, character in enumerate(self.characters):
+            h ^= CHARACTER_KEYS[i][self._location_index[character.location]]
+            
+        for achievement in self.current_achievements:
+            h ^= VISIBLE_KEYS[self._achievement_index[achievement]]
+        for achievement in self.achievement_deck.cards:
+            h ^= DECK_KEYS[self._achievement_index[achievement]]
+            
+        h ^= timer_key(self.timers)
+        if self.done:
+            h ^= DONE_KEY
+            
+        self._hash = h
+        
+    # Returns game state, called at the end of each step
+    def _get_obs(self):
+        
+        if self.canonical:
+            canonical_obs(self.obs, self._canonical_obs, self._fold_characters,
+                          self.config)
+            if self.copy_obs:
+                return self._canonical_obs.copy()
+            return self._canonical_view
+        
+        if self.copy_obs:
+            return self.obs.copy()
+        
+        return self._obs_view
+        
+    # Returns the SeedSequence, with its entropy and spawn key, which
+    # reproduces the game when passed back to seed()
     def seed(self, seed = None):
-        self.np_random, seed = seeding.np_random(seed)
-        return [seed]        
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.np_random = np.random.default_rng(seed)
+        self.roller.reseed(self.np_random)
+        return [seed]
         
     # This advances the state of the world one step, by passing in the
-    # action the AI takes.
+    # action the AI takes. The info has 'completed', the indices into
+    # self.achievements of any achievements completed on the step.
     def step(self, action):
         
-        self.score = 0        
-        
         # Make sure this is a valid action
         assert self.action_space.contains(action)
+        
+        if self.canonical and self._fold_characters:
+            action = real_action(action, [self._character_index[c]
+                                          for loc in self.locations
+                                          for c in loc.characters],
+                                 len(self.locations))
+        
+        self._play(action)
+            
+        # This isn't the usual sequencing for refilling pools - but
+        # in this modified game, they're filled after every move
+        for resource_pool in self.resource_pools:
+            resource_pool.refill()            
+            
+        return self._get_obs(), self.score, self.done, {'completed': self.completed}
+    
+    # Everything in a step up to refilling the pools, which is the only
+    # chance left in a turn once the deck order is known. Solvers call this
+    # directly to work through the possible refills themselves.
+    def _play(self, action):
+        
+        self.score = 0
+        self.completed = []
+        was_done = self.done
             
         # Move characters based on actions     
-        if action < 4:
-            self._move_character(self.characters[0], self.locations[action])
-        else:          
-            self._move_character(self.characters[1], self.locations[action - 4])
+        character, location = divmod(action, len(self.locations))
+        self._move_character(self.characters[character], self.locations[location])
         
         # Invest resources based on greedy heuristic
         for location in self.locations:
@@ -155,28 +302,31 @@ class SixWinters(gym.Env):
                 
                 self.current_achievements.remove(achievement)
                 self.score = self.score + 1
+                self.completed.append(self._achievement_index[achievement])
+                self._hash ^= VISIBLE_KEYS[self._achievement_index[achievement]]
                 
                 new_achievement = self.achievement_deck.draw()
 
                 if new_achievement is not None:
                     self.current_achievements.append(new_achievement)
+                    i = self._achievement_index[new_achievement]
+                    self._hash ^= DECK_KEYS[i] ^ VISIBLE_KEYS[i]
+                    
+                self._write_achievements()
                     
                 # All of the achievments are completed!
                 if not self.current_achievements:
                     self.done = True
         
         # For now, the game lasts a fixed number of rounds
+        self._hash ^= timer_key(self.timers) ^ timer_key(self.timers + 1)
         self.timers = self.timers + 1
         
-        if self.timers >= MAX_TIMERS:
+        if self.timers >= self.config.max_timers:
             self.done = True
             
-        # This isn't the usual sequencing for refilling pools - but
-        # in this modified game, they're filled after every move
-        for resource_pool in self.resource_pools:
-            resource_pool.refill()            
-            
-        return self._get_obs(), self.score, self.done, {}
+        if self.done and not was_done:
+            self._hash ^= DONE_KEY
         
     # Although it's a roundabout way to get object state, render decodes
     # the obs string. This is a sanity check that the ML Agent can see
@@ -185,6 +335,7 @@ class SixWinters(gym.Env):
     def render(self):
         
         obs = self._get_obs()
+        config = self.config
         
         try:
             
@@ -196,9 +347,9 @@ class SixWinters(gym.Env):
             
             print('--- Pools ---')
             for pool in self.resource_pools:
-                print(obs[INDEX:INDEX+6])
+                print(obs[INDEX:INDEX+config.pool_obs_size])
                 print(pool)
-                INDEX += 6
+                INDEX += config.pool_obs_size
             print('')
 
             print('--- Achievements ---')
@@ -206,7 +357,7 @@ class SixWinters(gym.Env):
                 print(self.current_achievements[i])
                 print(obs[INDEX:INDEX+3])
                 INDEX += 3
-            for i in range(2 - len(self.current_achievements)):
+            for i in range(config.num_visible_achievements - len(self.current_achievements)):
                 print('None')
                 print(obs[INDEX:INDEX+3])
                 INDEX+=3
@@ -214,9 +365,9 @@ class SixWinters(gym.Env):
             
             print('--- Locations ---')   
             for loc in self.locations:
-                print(obs[INDEX:INDEX+8])
+                print(obs[INDEX:INDEX+config.location_obs_size])
                 print(loc)
-                INDEX += 8
+                INDEX += config.location_obs_size
                 
             print('')
             
@@ -226,43 +377,158 @@ class SixWinters(gym.Env):
             print('Call reset()')
 
         
-    # Reset the state of the game world
-    def reset(self):
+    # Create the locations, characters, pools and achievements
+    def _build(self):
 
+        config = self.config
+        
         # Initialize characters and locations
-        self.locations = [Location('Ore Town', Resource.ORE, LOCATION_POOL_SIZE),
-                          Location('Timberville', Resource.TIMBER, LOCATION_POOL_SIZE),
-                          Location('Flavortown', Resource.FOOD, LOCATION_POOL_SIZE),
-                          Location('Manasberg', Resource.MANA, LOCATION_POOL_SIZE)]
+        self.locations = [Location(rule.name, rule.resource_type,
+                                   config.location_pool_size, config.dice_slots,
+                                   len(config.characters))
+                          for rule in config.locations]
         
-        self.characters = [Character('Keel', 1), Character('Thea', 2)]
+        self.characters = [Character(rule.name, rule.cid, command = rule.command)
+                           for rule in config.characters]
+        self._fold_characters = identical_characters(self.characters)
         
         # Make a deck of achievements
-        self.achievement_deck = Deck([])
+        self.achievement_deck = Deck([], self.roller)
         
         # Initialize resource pools
         self.resource_pools = []
         for resource in Resource:
-            self.resource_pools.append(ResourcePool(resource, RESOURCE_POOL_SIZE))
+            self.resource_pools.append(ResourcePool(resource, config.resource_pool_size,
+                                                    True, self.roller,
+                                                    config.dice_slots))
         
         # Initialize where characters are located
         for character in self.characters:
             character.location = self.locations[0]
-            self.locations[0].characters.append(character)
+            self.locations[0].arrive(character)
             
-        # Create initial four achievements, which map to the four location types
-        for next_resource in [Resource.TIMBER, Resource.MANA, Resource.ORE, Resource.FOOD]:
+        # Create the achievements, which map to the location types
+        self.achievements = []
+        for rule in config.achievements:
             
-            achievement = SumResourceAchievement('Gather', AchievementType.SUM, next_resource, 7)
-            self.achievement_deck.insert(achievement)
-
-        # Draw two starting achievements           
+            achievement = SumResourceAchievement('Gather', AchievementType.SUM,
+                                                 rule.resource_type, rule.total)
+            self.achievements.append(achievement)
+            
+        self.current_achievements = []
+        
+        # Lookups for snapshots
+        self._location_pools = [loc.rpool for loc in self.locations]
+        self._location_index = {loc: i for i, loc in enumerate(self.locations)}
+        self._character_index = {c: i for i, c in enumerate(self.characters)}
+        self._achievement_index = {a: i for i, a in enumerate(self.achievements)}
+        
+        # Each pool and location hashes its dice with its own keys
+        self._hashed_pools = self.resource_pools + self._location_pools
+        for slot, pool in enumerate(self._hashed_pools):
+            pool.hash_slot(slot)
+        
+        self.done = True
+        self.timers = 0
+        
+        self._bind_obs()
+        self._rehash()
+        
+    # Roll new resource pools and shuffle the achievement deck, returning
+    # the pool counts and deck order so the board can be banked
+    def _roll_start(self):
+        
+        for pool in self.resource_pools:
+            pool.reroll()
+            
+        self.achievement_deck.cards = list(self.achievements)
         self.achievement_deck.shuffle()
-        self.current_achievements = [self.achievement_deck.draw(),
-                                     self.achievement_deck.draw()]
+        
+        return (tuple(tuple(pool.counts) for pool in self.resource_pools),
+                tuple(self.achievements.index(a) for a in self.achievement_deck.cards))
+        
+    # Snapshot the game, cheaply enough to try out actions and roll back.
+    # Leave out the random state for search where later dice should differ.
+    def get_state(self, with_rng = True):
+        
+        characters = self._character_index
+        achievements = self._achievement_index
+        
+        return GameState(tuple([tuple(pool.counts) for pool in self.resource_pools]),
+                         tuple([tuple(pool.counts) for pool in self._location_pools]),
+                         tuple([tuple([characters[c] for c in loc.characters])
+                                for loc in self.locations]),
+                         tuple([achievements[a] for a in self.achievement_deck.cards]),
+                         tuple([achievements[a] for a in self.current_achievements]),
+                         self.timers,
+                         self.done,
+                         bytes(self._obs_buffer),
+                         self.roller.get_state() if with_rng else None)
+        
+    # Puts the game back into a snapshot from get_state()
+    def set_state(self, state):
+        
+        for pool, counts in zip(self.resource_pools, state.pools):
+            pool.restore(counts)
+            
+        for pool, counts in zip(self._location_pools, state.locations):
+            pool.restore(counts)
+            
+        for loc, characters in zip(self.locations, state.characters):
+            loc.characters[:] = [self.characters[i] for i in characters]
+            for character in loc.characters:
+                character.location = loc
+                
+        achievements = self.achievements
+        self.achievement_deck.cards = [achievements[i] for i in state.deck]
+        self.current_achievements = [achievements[i] for i in state.achievements]
+        
+        self.timers = state.timers
+        self.done = state.done
+        self._rehash()
+        
+        if state.obs is not None:
+            self._obs_buffer[:] = state.obs
+        else:
+            self._bind_obs()
+            
+        if state.rng is not None:
+            self.roller.set_state(state.rng)
+        
+    # Reset the state of the game world
+    def reset(self):
+        
+        # Either set up a banked starting board, or roll a new one
+        if self._reset_bank:
+            counts, order = self._reset_bank[self.roller.randrange(len(self._reset_bank))]
+            for pool, pool_counts in zip(self.resource_pools, counts):
+                pool.set_counts(pool_counts)
+            self.achievement_deck.cards = [self.achievements[i] for i in order]
+        else:
+            self._roll_start()
+        
+        # Clear the locations and send the characters back to the start
+        for loc in self.locations:
+            loc.rpool.clear()
+            
+        for character in self.characters:
+            character.location.leave(character)
+            
+        for character in self.characters:
+            character.location = self.locations[0]
+            self.locations[0].arrive(character)
+
+        # Draw the starting achievements
+        self.current_achievements = []
+        for i in range(self.config.num_visible_achievements):
+            achievement = self.achievement_deck.draw()
+            if achievement is not None:
+                self.current_achievements.append(achievement)
+        self._write_achievements()
         
         self.done = False
         self.timers = 0
+        self._rehash()
         
         return self._get_obs()
         
@@ -275,7 +541,7 @@ if __name__ == "__main__":
     done = False
     score = 0
     while not done:
-        action = (random.randint(0,7))
+        action = env.roller.randrange(env.action_space.n)
         print('Take Action', action)
         obs, r, done, info = env.step(action)
         score = score + r
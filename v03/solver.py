@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+An exact expectimax solver for Six Winters. Games are short and the only
+chance is the order of the achievement deck and the dice rolled to refill
+the pools, so the expected score of playing perfectly from a state can be
+worked out exactly. This gives a ground truth to measure learned policies
+against without sampling millions of games.
+
+The number of states grows by around 40x for every turn left to play, so
+solving the last few turns of a game takes seconds to minutes, while solving
+a full game from the opening is out of reach.
+"""
+
+import itertools
+import time
+from collections import OrderedDict
+from math import factorial
+
+from sixwinters import SixWinters
+from rules import DEFAULT_RULES
+
+# Every way that n dice can come up, as (face counts, probability)
+def roll_outcomes(n):
+    outcomes = []
+    for faces in itertools.combinations_with_replacement(range(6), n):
+        counts = [0] * 6
+        for face in faces:
+            counts[face] += 1
+        ways = factorial(n)
+        for count in counts:
+            ways //= factorial(count)
+        outcomes.append((tuple(counts), ways / 6 ** n))
+    return outcomes
+
+# Each entry in the transposition table holds a key of a dozen or so small
+# tuples and a float, around 1 KB. The default cap keeps the table to about
+# a GB.
+MAX_ENTRIES = 1000000
+
+# The table stores values only. Many states are folded together, so the best
+# action is only worked out for the state being solved.
+class ExpectimaxSolver:
+
+    def __init__(self, max_entries = MAX_ENTRIES, config = DEFAULT_RULES):
+        self.env = SixWinters(config = config)
+        self.max_entries = max_entries
+        self.table = OrderedDict()
+        self.nodes = 0
+        self.hits = 0
+        self.evictions = 0
+
+        env = self.env
+        self._pool_size = config.resource_pool_size
+        self._roll_outcomes = [roll_outcomes(n)
+                               for n in range(config.resource_pool_size + 1)]
+        self._location_types = [loc.rpool.resource_type.value
+                                for loc in env.locations]
+        self._achievement_types = [a.resource_type.value
+                                   for a in env.achievements]
+        self._identical_characters = all(c.skills == env.characters[0].skills
+                                         for c in env.characters)
+
+    def stats(self):
+        return {'nodes': self.nodes, 'hits': self.hits,
+                'evictions': self.evictions, 'entries': len(self.table)}
+
+    # Returns the optimal expected score from a state, along with the best
+    # action to take. The state may be a GameState, or a SixWinters
+    # environment to solve from its current position.
+    def solve(self, state):
+
+        if isinstance(state, SixWinters):
+            state = state.get_state(False)
+
+        state = state._replace(obs = None, rng = None)
+        if state.done:
+            return 0.0, None
+
+        return self._best(state)
+
+    # The best action from a state, and its expected score. No game can score
+    # more than the achievements left, so once an action is sure to get all
+    # of them the rest don't need to be tried.
+    def _best(self, state):
+
+        most = len(state.deck) + len(state.achievements)
+
+        best = None
+        for action in range(self.env.action_space.n):
+            value = self._action_value(state, action)
+            if best is None or value > best[0]:
+                best = (value, action)
+                if value >= most - 1e-9:
+                    break
+
+        return best
+
+    # Resource types which can still earn points
+    def _live_types(self, state):
+        types = self._achievement_types
+        return ({types[i] for i in state.deck} |
+                {types[i] for i in state.achievements})
+
+    # Folds together states with the same expected score. Only the set of
+    # cards left in the deck matters, not their order. Pools and locations
+    # for resources with no achievements left can't earn anything, and
+    # neither can characters standing at those locations. Characters with
+    # the same skills are interchangeable, and so are achievements of
+    # different resource types.
+    def _key(self, state):
+
+        live = self._live_types(state)
+        loc_live = [t in live for t in self._location_types]
+
+        pools = tuple([counts if t in live else None
+                       for t, counts in enumerate(state.pools)])
+        locations = tuple([counts if loc_live[i] else None
+                           for i, counts in enumerate(state.locations)])
+
+        positions = [-1] * len(self.env.characters)
+        for i, characters in enumerate(state.characters):
+            if loc_live[i]:
+                for c in characters:
+                    positions[c] = i
+        if self._identical_characters:
+            positions.sort()
+
+        achievements = state.achievements
+        types = [self._achievement_types[i] for i in achievements]
+        if len(set(types)) == len(types):
+            achievements = tuple(sorted(achievements))
+
+        return (pools, locations, tuple(positions), tuple(sorted(state.deck)),
+                achievements, state.timers)
+
+    def _value(self, state):
+
+        if state.done:
+            return 0.0
+
+        key = self._key(state)
+        value = self.table.get(key)
+        if value is not None:
+            self.hits += 1
+            self.table.move_to_end(key)
+            return value
+
+        self.nodes += 1
+        value = self._best(state)[0]
+
+        self.table[key] = value
+        if len(self.table) > self.max_entries:
+            self.table.popitem(last = False)
+            self.evictions += 1
+
+        return value
+
+    # Expected score from taking an action, averaged over every order the
+    # rest of the deck could be in
+    def _action_value(self, state, action):
+
+        orders = sorted(set(itertools.permutations(state.deck)))
+        total = 0.0
+
+        for deck in orders:
+            self.env.set_state(state._replace(deck = deck))
+            self.env._play(action)
+            after = self.env.get_state(False)
+            value = self.env.score + self._refill_value(after)
+
+            # Cards are only drawn when achievements are completed, which
+            # doesn't depend on the order of the deck
+            if after.deck == deck:
+                return value
+
+            total += value
+
+        return total / len(orders)
+
+    # Expected value of a state over every way its pools could be refilled
+    def _refill_value(self, state):
+
+        if state.done:
+            return 0.0
+
+        # Pools which can't earn anything are topped up with 1s rather than
+        # working through every roll
+        live = self._live_types(state)
+        pools = list(state.pools)
+        missing = []
+        for i, counts in enumerate(pools):
+            n = self._pool_size - sum(counts)
+            if n > 0 and i in live:
+                missing.append((i, n))
+            elif n > 0:
+                pools[i] = (counts[0] + n,) + counts[1:]
+
+        expected = 0.0
+        for outcome in itertools.product(*[self._roll_outcomes[n]
+                                             for i, n in missing]):
+            refilled = list(pools)
+            probability = 1.0
+            for (i, n), (counts, p) in zip(missing, outcome):
+                refilled[i] = tuple([a + b for a, b in zip(refilled[i], counts)])
+                probability *= p
+            expected += probability * self._value(state._replace(pools = tuple(refilled)))
+
+        return expected
+
+if __name__ == "__main__":
+
+    # Solve the last three turns of a game
+    env = SixWinters(seed = 1)
+    env.reset()
+    for action in [0, 0, 0, 0, 0, 0, 0]:
+        env.step(action)
+    env.render()
+
+    solver = ExpectimaxSolver()
+    start = time.perf_counter()
+    value, action = solver.solve(env)
+    elapsed = time.perf_counter() - start
+
+    print('Expected score', value, 'best action', action)
+    print(solver.stats(), f'{elapsed:.1f} sec')
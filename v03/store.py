@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+A local SQLite store of simulation results, so interrupted or repeated
+estimates and sweeps only play the games they haven't played before.
+
+Results are stored per chunk of games, keyed by a hash of everything that
+decides them: the rules, the policy, the master seed, chunk index and chunk
+size, and the version of the engine code. Editing the engine changes the
+code version, so old results are never mixed with new ones.
+
+Running this file lists or prunes the stored results.
+"""
+
+import argparse
+import ast
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import types
+
+import numpy as np
+
+# The modules which decide the result of a game are these, and every module
+# in the same directory that they import, directly or not. This module is
+# left out, as it only stores the results.
+ENGINE_ROOTS = ['sixwinters.py', 'estimator.py']
+
+# The modules in directory imported by the roots, found by reading their
+# import statements, so the list doesn't depend on what has been imported
+def engine_modules(directory, roots = ENGINE_ROOTS):
+    found = set()
+    pending = list(roots)
+    while pending:
+        name = pending.pop()
+        if name in found:
+            continue
+        found.add(name)
+        with open(os.path.join(directory, name), 'rb') as f:
+            tree = ast.parse(f.read(), name)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                modules = [node.module]
+            else:
+                continue
+            for module in modules:
+                path = module.split('.')[0] + '.py'
+                if os.path.exists(os.path.join(directory, path)):
+                    pending.append(path)
+    found.discard(os.path.basename(__file__))
+    return sorted(found)
+
+def _code_version():
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in engine_modules(directory):
+        digest.update(name.encode())
+        with open(os.path.join(directory, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+CODE_VERSION = _code_version()
+
+DEFAULT_PATH = 'results.sqlite'
+
+# The names a function's code reads, including code nested in it. These
+# are attribute names as well as globals.
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+# Adds a value a policy depends on to a digest. Functions are hashed by
+# their bytecode, constants, defaults, the values they close over and the
+# values of the globals they read, following global functions they call in
+# turn. Partials are hashed by their function and arguments, arrays by
+# their bytes, objects with a digest attribute by that, and anything else,
+# including modules and classes, by its repr, which has to be the same in
+# every process. So a change to a class or module a policy uses isn't
+# seen, nor is a change to an object other than through its repr.
+def _update_digest(digest, value, seen):
+
+    if isinstance(value, (types.FunctionType, types.CodeType, functools.partial,
+                          types.MethodType)):
+        if id(value) in seen:
+            digest.update(b'<recursive>')
+            return
+        seen.add(id(value))
+
+    if isinstance(value, functools.partial):
+        digest.update(b'partial')
+        for part in (value.func, value.args, sorted(value.keywords.items())):
+            _update_digest(digest, part, seen)
+
+    elif isinstance(value, types.MethodType):
+        digest.update(b'method')
+        _update_digest(digest, value.__func__, seen)
+        _update_digest(digest, value.__self__, seen)
+
+    elif isinstance(value, types.FunctionType):
+        digest.update(value.__qualname__.encode())
+        _update_digest(digest, value.__code__, seen)
+        _update_digest(digest, value.__defaults__, seen)
+        _update_digest(digest, sorted((value.__kwdefaults__ or {}).items()), seen)
+        for cell in value.__closure__ or ():
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                contents = '<empty cell>'
+            _update_digest(digest, contents, seen)
+        for name in sorted(_code_names(value.__code__)):
+            if name in value.__globals__:
+                digest.update(f'global {name}'.encode())
+                _update_digest(digest, value.__globals__[name], seen)
+
+    elif isinstance(value, types.CodeType):
+        digest.update(value.co_code)
+        digest.update(repr(value.co_names).encode())
+        _update_digest(digest, value.co_consts, seen)
+
+    elif isinstance(value, (tuple, list)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _update_digest(digest, item, seen)
+
+    elif isinstance(value, dict):
+        digest.update(f'dict{len(value)}'.encode())
+        for item in value.items():
+            _update_digest(digest, item, seen)
+
+    # Sets are sorted, as their order changes with the hash seed
+    elif isinstance(value, (set, frozenset)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for text in sorted(repr(item) for item in value):
+            digest.update(text.encode())
+
+    elif isinstance(value, np.ndarray):
+        digest.update(f'array{value.dtype}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+
+    elif getattr(value, 'digest', None) is not None:
+        digest.update(f'digest{value.digest}'.encode())
+
+    else:
+        text = repr(value)
+        if ' at 0x' in text:
+            raise ValueError(f'Can\'t digest {text}, give the policy a digest '
+                             'attribute to identify it')
+        digest.update(text.encode())
+
+# Identifies a policy. Policies with a digest attribute, e.g. one for a
+# checkpoint of their weights, use that. Otherwise functions, methods and
+# partials are identified by their name and a hash of their code and the
+# values it reads (see _update_digest for what is covered). Other
+# callables, and policies which depend on more than that, need a digest
+# attribute.
+def policy_digest(policy):
+
+    digest = getattr(policy, 'digest', None)
+    if digest is not None:
+        return str(digest)
+
+    if not isinstance(policy, (types.FunctionType, types.MethodType,
+                               functools.partial)):
+        raise ValueError(f'Can\'t digest the policy {policy!r}, give it a digest '
+                         'attribute to identify it')
+
+    # Policies from a script run directly are named after its file, so
+    # they match when the script is imported instead. Those from an
+    # interactive session, which has no file, are named __main__.
+    function = policy
+    while not isinstance(function, types.FunctionType):
+        if isinstance(function, functools.partial):
+            function = function.func
+        else:
+            function = function.__func__
+    module = getattr(function, '__module__', None) or '__main__'
+    if module == '__main__':
+        path = getattr(sys.modules['__main__'], '__file__', None)
+        if path is not None:
+            module = os.path.splitext(os.path.basename(path))[0]
+
+    hashed = hashlib.sha256()
+    _update_digest(hashed, policy, set())
+    return f'{module}.{function.__qualname__}:{hashed.hexdigest()[:16]}'
+
+def result_key(config, policy_id, master_seed, chunk, chunk_size,
+               code_version = CODE_VERSION):
+    text = repr((config, policy_id, master_seed, chunk, chunk_size, code_version))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class ResultStore:
+
+    def __init__(self, path = DEFAULT_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                                     key TEXT PRIMARY KEY,
+                                     config TEXT,
+                                     policy TEXT,
+                                     master_seed INTEGER,
+                                     chunk INTEGER,
+                                     chunk_size INTEGER,
+                                     code_version TEXT,
+                                     result TEXT,
+                                     created REAL,
+                                     hits INTEGER DEFAULT 0)''')
+        self.connection.commit()
+
+        # Lookups made through this store, and the hits on each key not
+        # yet written to the database
+        self.hits = 0
+        self.misses = 0
+        self._key_hits = {}
+
+    # Writes the hit counts kept since the last flush in one transaction
+    def flush_hits(self):
+        if self._key_hits:
+            self.connection.executemany('UPDATE results SET hits = hits + ? WHERE key = ?',
+                                        [(hits, key) for key, hits in self._key_hits.items()])
+            self.connection.commit()
+            self._key_hits.clear()
+
+    def close(self):
+        self.flush_hits()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    # Returns the stored result for a key, a dict, or None. Hits are counted
+    # in memory and written by flush_hits, when the store is closed.
+    def get(self, key):
+        row = self.connection.execute('SELECT result FROM results WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._key_hits[key] = self._key_hits.get(key, 0) + 1
+        return json.loads(row[0])
+
+    def put(self, key, result, config, policy_id, master_seed, chunk, chunk_size):
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                                (key, repr(config), policy_id, master_seed, chunk,
+                                 chunk_size, CODE_VERSION, json.dumps(result),
+                                 time.time()))
+        self.connection.commit()
+
+    # Each distinct run in the store, grouping its chunks together
+    def runs(self):
+        self.flush_hits()
+        return self.connection.execute(
+            '''SELECT config, policy, master_seed, chunk_size, code_version,
+                      COUNT(*), SUM(hits), MAX(created)
+               FROM results
+               GROUP BY config, policy, master_seed, chunk_size, code_version
+               ORDER BY MAX(created)''').fetchall()
+
+    # Deletes results, returning how many were deleted. stale deletes
+    # results from other versions of the code, and older_than those stored
+    # more than that many seconds ago.
+    def prune(self, stale = False, older_than = None, everything = False):
+        clauses = []
+        parameters = []
+        if stale:
+            clauses.append('code_version != ?')
+            parameters.append(CODE_VERSION)
+        if older_than is not None:
+            clauses.append('created < ?')
+            parameters.append(time.time() - older_than)
+        if not clauses and not everything:
+            return 0
+        where = ' OR '.join(clauses) if clauses else '1'
+        deleted = self.connection.execute(f'DELETE FROM results WHERE {where}',
+                                          parameters).rowcount
+        self.connection.commit()
+        return deleted
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'List or prune stored '
+                                     'simulation results.')
+    parser.add_argument('--db', default = DEFAULT_PATH)
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    commands.add_parser('list', help = 'list the stored runs')
+    prune = commands.add_parser('prune', help = 'delete stored results')
+    prune.add_argument('--stale', action = 'store_true',
+                       help = 'results from other versions of the code')
+    prune.add_argument('--older-than', type = float, default = None,
+                       help = 'results stored more than this many days ago')
+    prune.add_argument('--all', action = 'store_true', help = 'every result')
+    args = parser.parse_args()
+
+    with ResultStore(args.db) as store:
+
+        if args.command == 'list':
+            print(f'Code version {CODE_VERSION}')
+            for (config, policy, master_seed, chunk_size, code_version, chunks,
+                 hits, created) in store.runs():
+                current = 'current' if code_version == CODE_VERSION else 'stale'
+                print(f'{time.ctime(created)}  {policy}  seed {master_seed}  '
+                      f'{chunks} chunks of {chunk_size}  {hits} hits  '
+                      f'{code_version} ({current})')
+                print(f'    {config}')
+
+        elif args.command == 'prune':
+            older_than = None
+            if args.older_than is not None:
+                older_than = args.older_than * 24 * 60 * 60
+            deleted = store.prune(args.stale, older_than, args.all)
+            print(f'Deleted {deleted} results')
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Sweeps the design space of Six Winters. Each point in the sweep is a set of
+rule parameters, played for a number of games split into chunks, and every
+chunk is a job for a pool of processes. Results for each job are written to
+a CSV file as soon as the job finishes, with progress reported along the
+way.
+
+Every point plays the same seeds, chunk for chunk, so differences between
+points come from the rules rather than the dice.
+"""
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import random
+import sys
+import time
+
+from rules import DEFAULT_RULES, CharacterRule, AchievementRule
+from estimator import (random_policy, play_chunk, mean_interval, _init_worker,
+                       stored_chunk, store_chunk)
+from store import ResultStore, policy_digest
+
+# The rule parameters which can be swept, with their defaults
+PARAMETERS = {'max_timers': DEFAULT_RULES.max_timers,
+              'resource_pool_size': DEFAULT_RULES.resource_pool_size,
+              'location_pool_size': DEFAULT_RULES.location_pool_size,
+              'achievement_total': DEFAULT_RULES.achievements[0].total,
+              'num_characters': len(DEFAULT_RULES.characters)}
+
+# Builds the rules for a point in the sweep. Characters past the default
+# ones have the same skills as them.
+def make_config(max_timers, resource_pool_size, location_pool_size,
+                achievement_total, num_characters):
+
+    characters = list(DEFAULT_RULES.characters[:num_characters])
+    for cid in range(len(characters) + 1, num_characters + 1):
+        characters.append(CharacterRule(f'Character {cid}', cid,
+                                        DEFAULT_RULES.characters[0].command))
+
+    achievements = tuple([AchievementRule(rule.resource_type, achievement_total)
+                          for rule in DEFAULT_RULES.achievements])
+
+    return DEFAULT_RULES._replace(max_timers = max_timers,
+                                  resource_pool_size = resource_pool_size,
+                                  location_pool_size = location_pool_size,
+                                  characters = tuple(characters),
+                                  achievements = achievements)
+
+# Every combination of the given values, e.g. grid(max_timers = [8, 10]).
+# Parameters which aren't given keep their defaults.
+def grid(**values):
+    names = list(values)
+    points = []
+    for combination in itertools.product(*[values[name] for name in names]):
+        point = dict(PARAMETERS)
+        point.update(zip(names, combination))
+        points.append(point)
+    return points
+
+# n points, each parameter picked at random from its given values
+def random_sample(n, seed = 0, **values):
+    rng = random.Random(seed)
+    points = []
+    for i in range(n):
+        point = dict(PARAMETERS)
+        for name, choices in values.items():
+            point[name] = rng.choice(choices)
+        points.append(point)
+    return points
+
+# A job plays one chunk of games for one point
+def _run_job(job):
+
+    point_index, point, master_seed, chunk, chunk_size = job
+    start = time.perf_counter()
+    tally = play_chunk(master_seed, chunk, chunk_size, make_config(**point))
+
+    return job, tally, time.perf_counter() - start
+
+# A row of results for a job. Jobs read from a store took no time.
+def _row(job, tally, seconds):
+
+    point_index, point, master_seed, chunk, chunk_size = job
+
+    row = {'point': point_index}
+    row.update(point)
+    row.update({'seed': master_seed, 'chunk': chunk, 'games': tally.games,
+                'mean_score': mean_interval(tally.scores)[0],
+                'completion_rate': tally.scores[-1] / tally.games})
+    for score, count in enumerate(tally.scores):
+        row[f'score_{score}'] = int(count)
+    row['seconds'] = seconds
+
+    return row
+
+def _columns():
+    num_scores = len(DEFAULT_RULES.achievements) + 1
+    return (['point'] + list(PARAMETERS) +
+            ['seed', 'chunk', 'games', 'mean_score', 'completion_rate'] +
+            [f'score_{score}' for score in range(num_scores)] + ['seconds'])
+
+# Plays games_per_point games for every point, writing a row to path for
+# each chunk as it finishes. Rows arrive in the order jobs finish, so use
+# the point and chunk columns to put them back in order. Progress is
+# written to log every report_every seconds.
+#
+# With a ResultStore, jobs played before are written straight from the
+# store, so an interrupted sweep picks up where it left off, and only the
+# games still missing are played.
+def run_sweep(points, path, policy = random_policy, master_seed = 0,
+              games_per_point = 10000, chunk_size = 500, processes = None,
+              report_every = 5.0, log = sys.stderr, store = None):
+
+    chunks = -(-games_per_point // chunk_size)
+    jobs = [(i, point, master_seed, chunk,
+             min(chunk_size, games_per_point - chunk * chunk_size))
+            for i, point in enumerate(points)
+            for chunk in range(chunks)]
+
+    policy_id = policy_digest(policy)
+    configs = [make_config(**point) for point in points]
+
+    with open(path, 'w', newline = '') as f:
+
+        writer = csv.DictWriter(f, _columns())
+        writer.writeheader()
+
+        # Write out the jobs already in the store
+        missing = []
+        for job in jobs:
+            stored = None
+            if store is not None:
+                point_index, point, master_seed, chunk, size = job
+                stored = stored_chunk(store, configs[point_index], policy_id,
+                                      master_seed, chunk, size)
+            if stored is None:
+                missing.append(job)
+            else:
+                writer.writerow(_row(job, stored, 0.0))
+        f.flush()
+
+        if store is not None:
+            print(f'{len(jobs) - len(missing)}/{len(jobs)} jobs read from the store',
+                  file = log, flush = True)
+
+        total_games = sum(job[-1] for job in missing)
+        processes = processes or multiprocessing.cpu_count()
+        games = 0
+        start = last_report = time.perf_counter()
+
+        with multiprocessing.Pool(processes, _init_worker, (policy,)) as pool:
+
+            for done, (job, tally, seconds) in enumerate(
+                    pool.imap_unordered(_run_job, missing), 1):
+
+                writer.writerow(_row(job, tally, seconds))
+                f.flush()
+                games += tally.games
+
+                if store is not None:
+                    point_index, point, master_seed, chunk, size = job
+                    store_chunk(store, tally, configs[point_index], policy_id,
+                                master_seed, chunk, size)
+
+                now = time.perf_counter()
+                if now - last_report >= report_every or done == len(missing):
+                    last_report = now
+                    rate = games / (now - start)
+                    eta = (total_games - games) / rate if rate else float('inf')
+                    print(f'{done}/{len(missing)} jobs, {games} games, '
+                          f'{rate:.0f} games/sec, ETA {eta:.0f} sec',
+                          file = log, flush = True)
+
+    return games
+
+# Parses name=v1,v2,... into a parameter and its values
+def _parse_values(text):
+    name, values = text.split('=')
+    if name not in PARAMETERS:
+        raise argparse.ArgumentTypeError(f'Unknown parameter {name}, expected '
+                                         f'one of {", ".join(PARAMETERS)}')
+    return name, [int(v) for v in values.split(',')]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = 'Sweep Six Winters rule '
+                                     'parameters with a random policy.')
+    parser.add_argument('values', nargs = '*', type = _parse_values,
+                        help = 'parameter values, e.g. max_timers=8,10,12')
+    parser.add_argument('--samples', type = int, default = None,
+                        help = 'sample this many points at random instead of '
+                        'sweeping the whole grid')
+    parser.add_argument('--games', type = int, default = 10000,
+                        help = 'games per point')
+    parser.add_argument('--chunk-size', type = int, default = 500)
+    parser.add_argument('--processes', type = int, default = None)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--out', default = 'sweep.csv')
+    parser.add_argument('--store', default = None,
+                        help = 'reuse and save results in this SQLite file')
+    args = parser.parse_args()
+
+    values = dict(args.values)
+    if args.samples:
+        points = random_sample(args.samples, args.seed, **values)
+    else:
+        points = grid(**values)
+
+    store = ResultStore(args.store) if args.store else None
+
+    run_sweep(points, args.out, random_policy, args.seed, args.games,
+              args.chunk_size, args.processes, store = store)
+
+    if store is not None:
+        print('Store', store.stats())
+        store.close()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Folds together game states that only differ by a symmetry of the rules, so
+search, tabular learning and replay dedup see fewer distinct states. The
+characters have the same skills, so swapping them gives the same game, and
+the two visible achievements are unordered. Dice within a pool or location
+are already stored as counts, and encoded in sorted order.
+
+Characters are put in a canonical order by walking the locations in order,
+and the characters at each location in the order they arrived, which is the
+order they appear in the observation.
+"""
+
+import itertools
+
+from functools import lru_cache
+
+import numpy as np
+
+from rules import DEFAULT_RULES
+
+# Where the achievements and the character ids sit in an observation
+@lru_cache(maxsize = None)
+def obs_slots(config):
+    achievements = slice(config.achievements_offset, config.locations_offset)
+    characters = np.array([config.locations_offset + config.location_obs_size * loc +
+                           1 + config.dice_slots + i
+                           for loc in range(len(config.locations))
+                           for i in range(len(config.characters))])
+    return achievements, characters
+
+# Can the characters in a game be swapped?
+def identical_characters(characters):
+    return all(c.skills == characters[0].skills for c in characters)
+
+# The real character index for each canonical character, given the
+# character indices at each location in the order they arrived
+def character_order(characters):
+    return tuple([c for arrived in characters for c in arrived])
+
+# Maps an action on the canonical game to the same action on the real game
+def real_action(action, order, num_locations = len(DEFAULT_RULES.locations)):
+    character, location = divmod(action, num_locations)
+    return order[character] * num_locations + location
+
+# Maps an action on the real game to the same action on the canonical game
+def canonical_action(action, order, num_locations = len(DEFAULT_RULES.locations)):
+    character, location = divmod(action, num_locations)
+    return order.index(character) * num_locations + location
+
+# The canonical form of a GameState, along with the character order needed
+# to map actions back to the real game. The observation is left out, as it
+# no longer matches. With fold_characters = False, only the order characters
+# arrived and the order of the achievements are folded.
+def canonical_state(state, fold_characters = True):
+
+    if fold_characters:
+        order = character_order(state.characters)
+    else:
+        order = tuple(range(sum(len(arrived) for arrived in state.characters)))
+
+    rank = [0] * len(order)
+    for canonical, real in enumerate(order):
+        rank[real] = canonical
+
+    characters = tuple([tuple(sorted([rank[c] for c in arrived]))
+                        for arrived in state.characters])
+
+    return state._replace(characters = characters,
+                          achievements = tuple(sorted(state.achievements)),
+                          obs = None), order
+
+# Every state equivalent to the given one, including itself, e.g. for data
+# augmentation. The number of them is how many states the canonical form
+# folds together.
+def symmetric_states(state, fold_characters = True):
+
+    num_characters = sum(len(arrived) for arrived in state.characters)
+    if fold_characters:
+        relabelings = list(itertools.permutations(range(num_characters)))
+    else:
+        relabelings = [tuple(range(num_characters))]
+
+    states = set()
+    for relabel in relabelings:
+        arrivals = [[tuple([relabel[c] for c in order])
+                     for order in itertools.permutations(arrived)]
+                    for arrived in state.characters]
+        for characters in itertools.product(*arrivals):
+            for achievements in itertools.permutations(state.achievements):
+                states.add(state._replace(characters = characters,
+                                          achievements = achievements))
+    return states
+
+# The canonical form of an observation, or a batch of them with
+# observations along the last axis. Achievements are sorted with the empty
+# slot last, and characters are numbered 1, 2, ... in the order they
+# appear. The layout of the observation comes from the game's RulesConfig.
+def canonical_obs(obs, out = None, fold_characters = True, config = DEFAULT_RULES):
+
+    obs = np.asarray(obs)
+    if out is None:
+        out = obs.copy()
+    elif out is not obs:
+        out[...] = obs
+
+    achievement_slots, character_slots = obs_slots(config)
+    visible = config.num_visible_achievements
+
+    # Each achievement as a single number to sort by, with the empty ones
+    # (all zeros) sorting after the rest
+    achievements = out[..., achievement_slots].reshape(obs.shape[:-1] + (visible, 3))
+    keys = (achievements.astype(np.int64) * np.array([256 * 256, 256, 1])).sum(axis = -1)
+    keys = np.where(keys == 0, 1 << 24, keys)
+    order = np.argsort(keys, axis = -1, kind = 'stable')
+    achievements = np.take_along_axis(achievements, order[..., np.newaxis], axis = -2)
+    out[..., achievement_slots] = achievements.reshape(obs.shape[:-1] + (3 * visible,))
+
+    if fold_characters:
+        cids = out[..., character_slots]
+        present = cids > 0
+        out[..., character_slots] = np.cumsum(present, axis = -1) * present
+
+    return out
+
+if __name__ == "__main__":
+
+    from sixwinters import SixWinters
+
+    # Measure how much smaller the state space gets on random rollouts. The
+    # rollouts hardly ever revisit a state, so rather than counting distinct
+    # states, this averages how many states each one visited is folded
+    # together with.
+    env = SixWinters(seed = 0)
+    folded = []
+    observations = []
+
+    for game in range(2000):
+        env.reset()
+        done = False
+        while not done:
+            state = env.get_state(False)._replace(obs = None, rng = None)
+            variants = symmetric_states(state)
+
+            # The variants are all the same state once canonical, and
+            # observe the same once canonical
+            assert len({canonical_state(v)[0] for v in variants}) == 1
+            encoded = set()
+            canonical = set()
+            for variant in variants:
+                env.set_state(variant)
+                encoded.add(env.obs.tobytes())
+                canonical.add(canonical_obs(env.obs).tobytes())
+            assert len(canonical) == 1
+            env.set_state(state)
+
+            folded.append(len(variants))
+            observations.append(len(encoded))
+            obs, score, done, info = env.step(env.roller.randrange(env.action_space.n))
+
+    print(f'States: {np.mean(folded):.2f}x fewer, '
+          f'observations: {np.mean(observations):.2f}x fewer, '
+          f'over {len(folded)} states visited')
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+A batched counterpart to the SixWinters environment that plays N games at
+once. The state of every game lives in NumPy arrays, one row per game, with
+pools and locations stored as counts of each die face. A single call to
+step(actions) advances all of the games, and games which finish are reset
+automatically.
+"""
+
+import time
+
+import numpy as np
+from gym import spaces
+
+from resource import Resource
+from achievement import AchievementType
+from rules import DEFAULT_RULES
+
+# Dice are six sided
+NUM_FACES = 6
+
+# The batched games are played with the default rules. The tables below are
+# built for them, e.g. counts of each face are at most five.
+MAX_TIMERS = DEFAULT_RULES.max_timers
+RESOURCE_POOL_SIZE = DEFAULT_RULES.resource_pool_size
+LOCATION_POOL_SIZE = DEFAULT_RULES.location_pool_size
+
+# Pools and locations each encode five dice slots in the observation
+DICE_SLOTS = DEFAULT_RULES.dice_slots
+
+LOCATION_TYPES = [rule.resource_type for rule in DEFAULT_RULES.locations]
+CHARACTER_IDS = [rule.cid for rule in DEFAULT_RULES.characters]
+CHARACTER_COMMAND = [rule.command for rule in DEFAULT_RULES.characters]
+
+# Achievements in the order they are inserted into the deck, before shuffling
+ACHIEVEMENT_TYPES = [rule.resource_type for rule in DEFAULT_RULES.achievements]
+ACHIEVEMENT_TOTALS = [rule.total for rule in DEFAULT_RULES.achievements]
+NUM_VISIBLE_ACHIEVEMENTS = DEFAULT_RULES.num_visible_achievements
+
+NUM_POOLS = len(Resource)
+NUM_LOCATIONS = len(LOCATION_TYPES)
+NUM_CHARACTERS = len(CHARACTER_IDS)
+NUM_ACHIEVEMENTS = len(ACHIEVEMENT_TYPES)
+NUM_ACTIONS = NUM_CHARACTERS * NUM_LOCATIONS
+
+OBS_SIZE = (NUM_POOLS * (1 + DICE_SLOTS) + NUM_VISIBLE_ACHIEVEMENTS * 3 +
+            NUM_LOCATIONS * (1 + DICE_SLOTS + NUM_CHARACTERS))
+
+# Every subset of the sorted location dice, indexed by position, in
+# lexicographic order. When two subsets overshoot an achievement by the same
+# amount the first one listed spends the lowest dice, which is the same tie
+# break used by min_overshoot_cover.
+def _subset_masks(n):
+    masks = [[False] * n]
+
+    def visit(start, mask):
+        for i in range(start, n):
+            child = list(mask)
+            child[i] = True
+            masks.append(child)
+            visit(i + 1, child)
+
+    visit(0, masks[0])
+    return np.array(masks, dtype = bool)
+
+SUBSET_MASKS = _subset_masks(LOCATION_POOL_SIZE)
+
+# Expands face counts (..., 6) into sorted die values (..., slots), with
+# 0 for empty slots
+def sorted_values(counts, slots):
+    cum = counts.cumsum(axis = -1)
+    s = np.arange(slots)
+    values = 1 + (cum[..., np.newaxis, :] <= s[:, np.newaxis]).sum(axis = -1)
+    return np.where(s < cum[..., -1:], values, 0)
+
+# Face counts are at most 5, so a pool or location can be looked up by
+# reading its counts as a base 6 number
+COUNT_BASE = 6
+COUNT_WEIGHTS = COUNT_BASE ** np.arange(NUM_FACES)
+
+def _values_table():
+    digits = np.arange(COUNT_BASE ** NUM_FACES)[:, np.newaxis]
+    counts = digits // COUNT_WEIGHTS % COUNT_BASE
+    return sorted_values(counts, DICE_SLOTS).astype(np.uint8)
+
+VALUES_TABLE = _values_table()
+
+# Table lookup version of sorted_values for up to DICE_SLOTS dice
+def lookup_values(counts):
+    return VALUES_TABLE[counts @ COUNT_WEIGHTS]
+
+# Rolls rolls.shape[-1] dice into each pool, returning face counts
+# (..., 6). Only the first num_dice rolls of each pool are kept.
+def _roll_counts(rolls, num_dice):
+    keep = np.arange(rolls.shape[-1]) < num_dice[..., np.newaxis]
+    pools = np.arange(num_dice.size).reshape(num_dice.shape)
+    idx = pools[..., np.newaxis] * NUM_FACES + rolls
+    counts = np.bincount(idx[keep], minlength = num_dice.size * NUM_FACES)
+    return counts.reshape(num_dice.shape + (NUM_FACES,))
+
+class VecSixWinters:
+
+    def __init__(self, num_envs, seed = None):
+
+        self.num_envs = num_envs
+
+        # The same spaces as a single SixWinters game
+        self.action_space = spaces.Discrete(NUM_ACTIONS)
+        self.observation_space = spaces.MultiDiscrete([6] * OBS_SIZE)
+
+        self._location_types = np.array([r.value for r in LOCATION_TYPES])
+        self._location_of_type = np.full(NUM_POOLS, -1)
+        for i, r in enumerate(LOCATION_TYPES):
+            self._location_of_type[r.value] = i
+
+        self._cids = np.array(CHARACTER_IDS)
+        self._command = np.array(CHARACTER_COMMAND)
+        self._achievement_types = np.array([r.value for r in ACHIEVEMENT_TYPES])
+        self._achievement_totals = np.array(ACHIEVEMENT_TOTALS)
+        self._rows = np.arange(num_envs)
+
+        # Struct of arrays game state, one row per game
+        n = num_envs
+        self.pools = np.zeros((n, NUM_POOLS, NUM_FACES), dtype = np.int8)
+        self.location_dice = np.zeros((n, NUM_LOCATIONS, NUM_FACES),
+                                      dtype = np.int8)
+        self.positions = np.zeros((n, NUM_CHARACTERS), dtype = np.int8)
+        self.arrivals = np.zeros((n, NUM_CHARACTERS), dtype = np.int32)
+        self.deck = np.zeros((n, NUM_ACHIEVEMENTS), dtype = np.int8)
+        self.deck_index = np.zeros(n, dtype = np.int8)
+        self.current_achievements = np.full((n, NUM_VISIBLE_ACHIEVEMENTS), -1,
+                                            dtype = np.int8)
+        self.timers = np.zeros(n, dtype = np.int16)
+        self.dones = np.zeros(n, dtype = bool)
+
+        self.seed(seed)
+
+    def seed(self, seed = None):
+        self.np_random = np.random.default_rng(seed)
+        return [seed]
+
+    # Starts new games in the rows picked out by the boolean mask
+    def _reset_games(self, mask):
+
+        rows = np.nonzero(mask)[0]
+        n = len(rows)
+        if n == 0:
+            return
+
+        rolls = self.np_random.integers(0, NUM_FACES,
+                                        size = (n, NUM_POOLS, RESOURCE_POOL_SIZE))
+        full = np.full((n, NUM_POOLS), RESOURCE_POOL_SIZE)
+        self.pools[rows] = _roll_counts(rolls, full)
+        self.location_dice[rows] = 0
+
+        # Both characters start at the first location, in order
+        self.positions[rows] = 0
+        self.arrivals[rows] = np.arange(NUM_CHARACTERS)
+
+        # Shuffle the achievement deck and draw the starting achievements
+        order = self.np_random.random((n, NUM_ACHIEVEMENTS)).argsort(axis = 1)
+        self.deck[rows] = order
+        self.current_achievements[rows] = order[:, :NUM_VISIBLE_ACHIEVEMENTS]
+        self.deck_index[rows] = NUM_VISIBLE_ACHIEVEMENTS
+
+        self.timers[rows] = 0
+        self.dones[rows] = False
+
+    def reset(self):
+        self._reset_games(np.ones(self.num_envs, dtype = bool))
+        return self._get_obs()
+
+    # Vectorized greedy_invest_resources for a single location
+    def _invest(self, loc):
+
+        rows = self._rows
+        rt = self._location_types[loc]
+        here = self.positions == loc
+        skill_total = (self._command * here).sum(axis = 1)
+
+        # What's the largest die that can be taken
+        pool = self.pools[:, rt]
+        faces = np.arange(1, NUM_FACES + 1)
+        available = (pool > 0) & (faces <= skill_total[:, np.newaxis])
+        take = here.any(axis = 1) & available.any(axis = 1)
+        die = NUM_FACES - 1 - available[:, ::-1].argmax(axis = 1)
+
+        # Does the location have space available, if so, fill it
+        dice = self.location_dice[:, loc]
+        space = dice.sum(axis = 1) < LOCATION_POOL_SIZE
+        add = np.nonzero(take & space)[0]
+        self.pools[add, rt, die[add]] -= 1
+        self.location_dice[add, loc, die[add]] += 1
+
+        # Otherwise, attempt to swap out the lowest die on the location
+        lowest = (dice > 0).argmax(axis = 1)
+        trade = take & ~space & (dice[rows, lowest] > 0) & (lowest < die)
+        t = np.nonzero(trade)[0]
+        self.location_dice[t, loc, lowest[t]] -= 1
+        self.location_dice[t, loc, die[t]] += 1
+        self.pools[t, rt, die[t]] -= 1
+        self.pools[t, rt, lowest[t]] += 1
+
+    # Vectorized SumResourceAchievement.completed and pay_for_achievement
+    # for one of the visible achievement slots. Returns a mask of the games
+    # where the achievement was completed.
+    def _complete(self, achievements):
+
+        rows = self._rows
+        valid = achievements >= 0
+        ach = np.where(valid, achievements, 0)
+        loc = self._location_of_type[self._achievement_types[ach]]
+        valid &= loc >= 0
+        loc = np.where(valid, loc, 0)
+
+        values = lookup_values(self.location_dice[rows, loc])
+        values = values[:, :LOCATION_POOL_SIZE].astype(np.int64)
+        present = values > 0
+        sums = values @ SUBSET_MASKS.T
+        usable = ~(SUBSET_MASKS & ~present[:, np.newaxis, :]).any(axis = 2)
+        covers = usable & (sums >= self._achievement_totals[ach][:, np.newaxis])
+
+        # The lowest total wins, ties going to the first subset visited
+        best = np.where(covers, sums, np.iinfo(sums.dtype).max).argmin(axis = 1)
+        completed = valid & covers.any(axis = 1)
+
+        # Remove the dice used to pay for the achievement
+        paid = SUBSET_MASKS[best] & completed[:, np.newaxis]
+        for i in range(LOCATION_POOL_SIZE):
+            p = np.nonzero(paid[:, i])[0]
+            self.location_dice[p, loc[p], values[p, i] - 1] -= 1
+
+        return completed
+
+    # Advances every game one turn. Finished games are reset, and the
+    # observation returned for them is the start of the next game. The
+    # final observation of those games is returned in info.
+    def step(self, actions):
+
+        rows = self._rows
+        actions = np.asarray(actions)
+        assert actions.shape == (self.num_envs,)
+        assert ((actions >= 0) & (actions < NUM_ACTIONS)).all()
+
+        # Move characters based on actions, a character that moves
+        # arrives after anyone already at the location
+        character = actions // NUM_LOCATIONS
+        self.positions[rows, character] = actions % NUM_LOCATIONS
+        self.arrivals[rows, character] = self.timers + NUM_CHARACTERS
+
+        # Invest resources based on greedy heuristic
+        for loc in range(NUM_LOCATIONS):
+            self._invest(loc)
+
+        # Check to see if achievements have been completed, in the order
+        # they were visible at the start of the turn
+        visible = self.current_achievements.copy()
+        completed = np.zeros(visible.shape, dtype = bool)
+        for slot in range(NUM_VISIBLE_ACHIEVEMENTS):
+            completed[:, slot] = self._complete(visible[:, slot])
+
+        rewards = completed.sum(axis = 1)
+
+        # Completed achievements are replaced by cards from the deck, which
+        # are added after the remaining visible achievements
+        drawn = np.full(visible.shape, -1, dtype = np.int8)
+        for slot in range(NUM_VISIBLE_ACHIEVEMENTS):
+            d = np.nonzero((rewards > slot) &
+                           (self.deck_index < NUM_ACHIEVEMENTS))[0]
+            drawn[d, slot] = self.deck[d, self.deck_index[d]]
+            self.deck_index[d] += 1
+
+        candidates = np.concatenate([np.where(completed, -1, visible), drawn],
+                                    axis = 1)
+        order = (candidates < 0).argsort(axis = 1, kind = 'stable')
+        candidates = np.take_along_axis(candidates, order, axis = 1)
+        self.current_achievements[:] = candidates[:, :NUM_VISIBLE_ACHIEVEMENTS]
+
+        # All of the achievements are completed!
+        self.dones |= (rewards > 0) & (self.current_achievements < 0).all(axis = 1)
+
+        # For now, the game lasts a fixed number of rounds
+        self.timers += 1
+        self.dones |= self.timers >= MAX_TIMERS
+
+        # Pools are refilled after every move
+        missing = RESOURCE_POOL_SIZE - self.pools.sum(axis = 2)
+        rolls = self.np_random.integers(0, NUM_FACES,
+                                        size = missing.shape + (RESOURCE_POOL_SIZE,))
+        self.pools += _roll_counts(rolls, missing).astype(np.int8)
+
+        obs = self._get_obs()
+        dones = self.dones.copy()
+        info = {'terminal_obs': obs[dones]}
+
+        if dones.any():
+            self._reset_games(dones)
+            obs[dones] = self._get_obs()[dones]
+
+        return obs, rewards, dones, info
+
+    # Encodes every game the same way as SixWinters._get_obs()
+    def _get_obs(self):
+
+        n = self.num_envs
+        obs = np.zeros((n, OBS_SIZE), dtype = np.uint8)
+
+        i = 0
+        pool_values = lookup_values(self.pools)
+        for rt in range(NUM_POOLS):
+            obs[:, i] = rt
+            obs[:, i + 1:i + 1 + DICE_SLOTS] = pool_values[:, rt]
+            i += 1 + DICE_SLOTS
+
+        for slot in range(NUM_VISIBLE_ACHIEVEMENTS):
+            ach = self.current_achievements[:, slot]
+            valid = ach >= 0
+            ach = np.where(valid, ach, 0)
+            obs[:, i] = valid * AchievementType.SUM.value
+            obs[:, i + 1] = valid * self._achievement_types[ach]
+            obs[:, i + 2] = valid * self._achievement_totals[ach]
+            i += 3
+
+        # Characters at a location are listed in the order they arrived
+        order = self.arrivals.argsort(axis = 1, kind = 'stable')
+        positions = np.take_along_axis(self.positions, order, axis = 1)
+        cids = self._cids[order]
+
+        location_values = lookup_values(self.location_dice)
+        for loc in range(NUM_LOCATIONS):
+            obs[:, i] = self._location_types[loc]
+            obs[:, i + 1:i + 1 + DICE_SLOTS] = location_values[:, loc]
+            here = positions == loc
+            rank = here.cumsum(axis = 1) - 1
+            for c in range(NUM_CHARACTERS):
+                r = np.nonzero(here[:, c])[0]
+                obs[r, i + 1 + DICE_SLOTS + rank[r, c]] = cids[r, c]
+            i += 1 + DICE_SLOTS + NUM_CHARACTERS
+
+        return obs
+
+if __name__ == "__main__":
+
+    # Random play across a batch of games, reporting throughput
+    num_envs = 4096
+    num_steps = 200
+    env = VecSixWinters(num_envs, seed = 0)
+    obs = env.reset()
+
+    rng = np.random.default_rng(1)
+    games = 0
+    score = 0
+    start = time.perf_counter()
+    for step in range(num_steps):
+        actions = rng.integers(0, NUM_ACTIONS, size = num_envs)
+        obs, rewards, dones, info = env.step(actions)
+        score += rewards.sum()
+        games += dones.sum()
+    elapsed = time.perf_counter() - start
+
+    print(obs.shape)
+    print('Games finished', games, 'average score', score / max(games, 1))
+    print('Steps/sec', int(num_envs * num_steps / elapsed))
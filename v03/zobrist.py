@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Zobrist keys for hashing Six Winters game states. Every piece of the state
+(a die in a pool or location, a character at a location, an achievement
+showing or in the deck, the timer) has a random 64 bit key, and the hash of
+a state is the XOR of the keys of its pieces. When a piece changes, the
+hash is updated by XORing out the old key and XORing in the new one.
+
+Keys come from a fixed seed using splitmix64, so hashes are the same in
+every process and can be shared between workers.
+"""
+
+ZOBRIST_SEED = 0x53495857494E5453
+
+MASK = (1 << 64) - 1
+
+# Pools and locations get their own keys, by slot
+MAX_CONTAINERS = 16
+
+# The most dice of one face that a single pool or location can hold
+MAX_COPIES = 16
+
+MAX_CHARACTERS = 16
+MAX_LOCATIONS = 16
+MAX_ACHIEVEMENTS = 64
+MAX_TIMERS = 256
+
+def splitmix64(seed):
+    state = seed
+    while True:
+        state = (state + 0x9E3779B97F4A7C15) & MASK
+        z = state
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK
+        yield z ^ (z >> 31)
+
+_keys = splitmix64(ZOBRIST_SEED)
+
+# DIE_KEYS[container][face][k] is the key for the (k + 1)th die of a face
+DIE_KEYS = [[[next(_keys) for k in range(MAX_COPIES)]
+             for face in range(6)]
+            for container in range(MAX_CONTAINERS)]
+
+CHARACTER_KEYS = [[next(_keys) for location in range(MAX_LOCATIONS)]
+                  for character in range(MAX_CHARACTERS)]
+
+VISIBLE_KEYS = [next(_keys) for i in range(MAX_ACHIEVEMENTS)]
+DECK_KEYS = [next(_keys) for i in range(MAX_ACHIEVEMENTS)]
+
+TIMER_KEYS = [next(_keys) for i in range(MAX_TIMERS)]
+DONE_KEY = next(_keys)
+
+# DIE_PREFIX[container][face][count] is the hash of count dice of a face,
+# so a whole pool can be hashed from its face counts in six lookups
+def _prefixes(keys):
+    prefixes = [0]
+    for key in keys:
+        prefixes.append(prefixes[-1] ^ key)
+    return prefixes
+
+DIE_PREFIX = [[_prefixes(face_keys) for face_keys in container_keys]
+              for container_keys in DIE_KEYS]
+
+# Pools that aren't part of a hashed game use keys of 0
+NO_KEYS = [[0] * MAX_COPIES for face in range(6)]
+NO_PREFIX = [[0] * (MAX_COPIES + 1) for face in range(6)]
+
+def timer_key(timers):
+    return TIMER_KEYS[timers % MAX_TIMERS]
+
+if __name__ == "__main__":
+
+    print(hex(DIE_KEYS[0][0][0]), hex(DONE_KEY))